@@ -1,6 +1,6 @@
 import system, backend, velmex
 import sys, socket, threading, subprocess, time, logging
-from gigex import cmd_port
+from sync import CommandClient
 import command
 
 backend_ips = ['192.168.1.101', '192.168.1.102', '192.168.1.103', '192.168.1.104']
@@ -10,10 +10,13 @@ class Acquisition:
         # sinks can be a list of:
         # filenames -> singles acq
         # sockets -> coincidence acq
+        # RotatingWriters -> singles acq that can move on to new files
 
         self.stop_ev = threading.Event()
         self.acq_threads = []
         self.running = []
+        self.client = None
+        self.sinks = sinks
 
         for ip, sink in zip(backend_ips, sinks):
             r = threading.Event()
@@ -35,15 +38,27 @@ class Acquisition:
         for thr in self.acq_threads:
             thr.join()
 
-    @staticmethod
-    def reset():
-        c = socket.create_connection(('127.0.0.1', cmd_port))
-        cmd = command.CMD_EMPTY
-        c.send(cmd.to_bytes(4, 'big'))
-        resp = c.recv(4)
-        c.close()
-
-        resp = int.from_bytes(resp, 'big')
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def rotate(self, files, timeout = 10.0):
+        """ switch RotatingWriter sinks to new files without stopping
+        the receive threads, returns True once all have switched
+        """
+        events = [s.rotate(f) for s, f in zip(self.sinks, files)]
+        return all([ev.wait(timeout) for ev in events])
+
+    def command(self, words, device = 0):
+        """ send command words to the sync board (device 0) or a backend
+        (1 to 4) through the running UI, over one persistent connection
+        """
+        if self.client is None:
+            self.client = CommandClient()
+        return self.client.send_many(words, device)
+
+    def reset(self):
+        resp = self.command([command.CMD_EMPTY])[0]
         if resp != (command.CMD_EMPTY | 0x1):
             logging.error(f'Got response {hex(resp)} when performing reset')
         else:
@@ -91,29 +106,4 @@ if __name__ == "__main__":
     print('stopping...')
     acq.stop()
 
-#    stage = velmex.VelmexStage('/dev/ttyUSB5')
-#    stage.move(distance_to_first_ring - 5)
-#
-#    print('clearing data...')
-#    acq = Acquisition(['/dev/null'] * 4)
-#    acq.wait()
-#    time.sleep(10)
-#    acq.stop()
-#    print('cleared')
-#
-#    for i in range(nrings):
-#        print(f'acq {i} starting...')
-#
-#        files = [f'/mnt/acq/{i}_{ip}.SGL' for ip in backend_ips]
-#        acq = Acquisition(files)
-#        acq.wait()
-#        acq.reset()
-#
-#        print('acq started')
-#
-#        time.sleep(step_duration)
-#        stage.incr(step_size)
-#
-#        print('stopping...')
-#        acq.stop()
-#        print('acq stopped')
+    # ring scans with the stage: see scan.py
@@ -0,0 +1,117 @@
+import os, json, time, logging
+from sinks import FileWriter, RotatingWriter
+from acquire import Acquisition, backend_ips
+import velmex
+
+# Step-and-shoot ring scans. The data sockets stay open for the whole
+# scan: at the end of every dwell the stage is sent to the next ring and
+# the files are rotated at the same time, so the previous ring's files
+# are flushed and closed while the stage moves. Every file gets a .pos
+# sidecar tagging its data with the stage position.
+
+class PositionTagger():
+    """ Sink wrapper that tags the data with the stage state
+
+    A JSON line {offset, time, position, moving} is appended to tag_path
+    for the first chunk and whenever the stage position or motion state
+    changes, it applies to the data from offset (in bytes from the start
+    of this sink) up to the next tag. Only the cached stage state is
+    read, the serial port is never touched from the receive loop.
+    """
+
+    def __init__(self, sink, stage, tag_path):
+        self.sink = sink
+        self.stage = stage
+        self.path = getattr(sink, 'path', None)
+        self.tags = open(tag_path, 'w')
+        self.offset = 0
+        self.last = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'PositionTagger({self.sink})'
+
+    def write(self, data):
+        state = self.stage.tag()
+        if state != self.last:
+            position, moving = state
+            self.tags.write(json.dumps({'offset': self.offset, 'time': time.time(),
+                                        'position': position, 'moving': moving}) + '\n')
+            self.last = state
+
+        self.sink.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        self.sink.close()
+        self.tags.close()
+
+def tagged_files(stage, factory = FileWriter):
+    """ RotatingWriter factory giving every file but /dev/null a .pos
+    sidecar, /dev/null is a plain file as it can't be synced or truncated
+    """
+    return lambda path: (open(path, 'wb') if path == os.devnull else
+                         PositionTagger(factory(path), stage, path + '.pos'))
+
+class RingScan():
+    """ Acquire dwell seconds at each stage position
+
+    name(i, ip) is the file of ring i for a backend. The move to ring
+    i+1 is started together with the rotation to its files, the dwell
+    timer starts once the stage reports the move as finished; data taken
+    while moving is at the start of the file, tagged moving.
+    """
+
+    def __init__(self, stage, positions, dwell, name, reset = True):
+        self.stage = stage
+        self.positions = positions
+        self.dwell = dwell
+        self.name = name
+        self.reset = reset
+        self.acq = None
+
+    def run(self, warmup = 10.0):
+        # discard the data until the first ring is reached
+        self.stage.move(self.positions[0])
+        factory = tagged_files(self.stage)
+        self.acq = Acquisition([RotatingWriter(os.devnull, factory) for ip in backend_ips])
+        self.acq.wait()
+        time.sleep(warmup)
+
+        try:
+            for i, pos in enumerate(self.positions):
+                t = time.monotonic()
+                motion = self.stage.move(pos, wait = False)
+                if not self.acq.rotate([self.name(i, ip) for ip in backend_ips]):
+                    logging.warning(f'Ring {i}: not every backend switched files')
+                if i == 0 and self.reset: self.acq.reset()
+
+                reached = motion.result(self.stage.motion_timeout)
+                logging.info(f'Ring {i} at {reached:.3f} mm after {time.monotonic() - t:.2f}s')
+                time.sleep(self.dwell)
+        finally:
+            self.acq.stop()
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level = logging.INFO)
+
+    nrings = 80 + 10
+    step_duration = 60
+    step_size = 1.0 # mm between rings
+    distance_to_middle = 101.95 - 0.5
+    distance_to_first_ring = distance_to_middle - 39.75 + 0.5
+
+    stage = velmex.VelmexStage('/dev/ttyUSB5')
+    scan = RingScan(stage,
+            [distance_to_first_ring - 5 + i*step_size for i in range(nrings)],
+            step_duration, lambda i, ip: f'/mnt/acq/{i}_{ip}.SGL')
+
+    scan.run()
+    stage.close()
+    print('acq stopped')
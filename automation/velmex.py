@@ -1,52 +1,156 @@
-import serial
+import serial, threading, logging, collections
+from concurrent.futures import Future
 
 class VelmexStage:
+    """ VXM controller driver
+
+    A reader thread owns the serial input and consumes whatever is
+    buffered, so commands don't block on the port: a motion program
+    returns a Future that resolves to the final position in mm once the
+    controller reports the end of the program ('^') and the position has
+    been read back. While a program runs the position is polled ('X')
+    every poll_interval seconds, tag() returns the latest known state
+    without touching the port.
+
+    home, incr, move and zero wait for the motion unless called with
+    wait = False, which returns the Future.
+    """
+
     # Stage is XN10-0060-M01-71 -> 6" travel distance, 1mm per turn
     adv_per_turn = 1.00 # mm
     steps_per_turn = 400 # number of motor steps to make 1 full turn
 
+    # total travel distance is 152mm @ 5mm/sec -> ~30s
+    motion_timeout = 35.0
+
     @staticmethod
     def mm_to_steps(mm):
         return mm * VelmexStage.adv_per_turn * VelmexStage.steps_per_turn
 
-    def query(self, cmd_str, wait = True):
+    @staticmethod
+    def steps_to_mm(steps):
+        return steps / (VelmexStage.adv_per_turn * VelmexStage.steps_per_turn)
+
+    def __init__(self, device_file = '/dev/ttyUSB0', poll_interval = 0.1):
+        self.dev = serial.Serial(device_file, timeout = 0.1)
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.exit = threading.Event()
+
+        self.programs = collections.deque() # futures waiting for '^'
+        self.replies = collections.deque()  # (future, ends a program) waiting for a position
+        self.position = None # mm from zero, None until read back
+        self.moving = False
+
+        self.reader = threading.Thread(target = self.read_loop, daemon = True)
+        self.poller = threading.Thread(target = self.poll_loop, daemon = True)
+        self.reader.start()
+        self.poller.start()
+
+        self.run('C, E S1M2000, R', True) # set speed to 5mm / sec
+        self.home()
+        self.zero()
+
+    def close(self):
+        self.exit.set()
+        self.poller.join()
+        self.reader.join()
+        self.dev.close()
+
+    def write(self, cmd_str):
         written = self.dev.write(cmd_str.encode('ascii'))
-        print(f'Write {cmd_str}: {written} bytes sent')
+        logging.debug(f'Velmex write {cmd_str}: {written} bytes sent')
 
-        read_str = ''
-        while wait:
-            read_str += self.dev.read().decode('ascii')
-            # caret indicates end of response
-            if read_str[-1] == '^': break
+    def query(self, cmd_str):
+        """ start a motion program, returns its Future """
+        fut = Future()
+        with self.lock:
+            self.programs.append(fut)
+            self.moving = True
+            self.write(cmd_str)
+        return fut
 
-        print(f'Read back: \'{read_str}\'')
-        return read_str
+    def get_position(self):
+        """ Future of the current position in mm """
+        fut = Future()
+        with self.lock:
+            self.replies.append((fut, False))
+            self.write('X')
+        return fut
 
-    def home(self):
-        return self.query('C, E I1M-0, R') # go to negative limit
+    def tag(self):
+        """ latest known (position, moving) """
+        with self.lock:
+            return self.position, self.moving
 
-    def incr(self, mm):
+    def read_loop(self):
+        buf = ''
+        while not self.exit.is_set():
+            data = self.dev.read(max(1, self.dev.in_waiting))
+            if len(data) == 0: continue
+            buf += data.decode('ascii', errors = 'replace')
+
+            while True:
+                # caret indicates the end of a program, a carriage return
+                # the end of a position
+                ends = [i for i in (buf.find('^'), buf.find('\r')) if i >= 0]
+                if len(ends) == 0: break
+                i = min(ends)
+                reply, buf = buf[:i+1], buf[i+1:]
+                self.dispatch(reply)
+
+    def dispatch(self, reply):
+        logging.debug(f'Velmex read back: {reply!r}')
+        with self.lock:
+            # echoed command text may come before the caret
+            if reply.endswith('^'):
+                if len(self.programs) > 0:
+                    # read back where the program ended before resolving
+                    self.replies.append((self.programs.popleft(), True))
+                    self.write('X')
+                return
+
+            try:
+                pos = self.steps_to_mm(int(reply.strip().lstrip('X')))
+            except ValueError:
+                logging.warning(f'Velmex unexpected reply {reply!r}')
+                return
+
+            fut, ends_program = self.replies.popleft() if self.replies else (None, False)
+            self.position = pos
+            if ends_program:
+                self.moving = len(self.programs) > 0
+
+        if fut is not None: fut.set_result(pos)
+
+    def poll_loop(self):
+        while not self.exit.wait(self.poll_interval):
+            if self.moving and len(self.replies) == 0:
+                self.get_position()
+
+    def run(self, cmd_str, wait):
+        fut = self.query(cmd_str)
+        return fut.result(self.motion_timeout) if wait else fut
+
+    def home(self, wait = True):
+        return self.run('C, E I1M-0, R', wait) # go to negative limit
+
+    def incr(self, mm, wait = True):
         # increment the current position
         steps = round(self.mm_to_steps(mm))
-        return self.query(f'C, E I1M{steps}, R')
+        return self.run(f'C, E I1M{steps}, R', wait)
 
-    def move(self, mm):
+    def move(self, mm, wait = True):
         # move to a position relative to the zero'ed position
         steps = round(self.mm_to_steps(mm))
-        return self.query(f'C, E IA1M{steps}, R')
+        return self.run(f'C, E IA1M{steps}, R', wait)
 
-    def zero(self):
-        return self.query('C, E IA1M-0, R')
-
-    def __init__(self, device_file = '/dev/ttyUSB0'):
-        # total travel distance is 152mm @ 5mm/sec -> ~30s timeout
-        self.dev = serial.Serial(device_file, timeout = 35.0)
-        self.query('C, E S1M2000, R') # set speed to 5mm / sec
-        self.home()
-        self.zero()
+    def zero(self, wait = True):
+        return self.run('C, E IA1M-0, R', wait)
 
 if __name__ == "__main__":
     distance_to_middle = 101.95 - 0.5
     distance_to_first_ring = distance_to_middle - 39.75 + 0.5
     stage = VelmexStage('/dev/ttyUSB5')
     stage.move(distance_to_first_ring)
+    stage.close()
@@ -1,7 +1,10 @@
-import socket, logging, threading, queue, time
+import os, socket, logging, threading, queue, time, contextlib, collections, json
 import command as cmd
-from gigex import Gigex, ignore_network_errors
-from frontend import Frontend
+from gigex import Gigex, Backoff, ignore_network_errors
+from sinks import Tee, SinkStats, FileWriter
+from preview import Preview
+import metrics
+from frontend import Frontend, temp_channels, adc_to_temp
 from datetime import datetime
 from logging.handlers import WatchedFileHandler
 
@@ -13,38 +16,214 @@ monitor_log.addHandler(fhandle)
 monitor_log.setLevel(logging.INFO)
 monitor_log.propagate = False
 
+# One monitor reading of a backend, time is time.monotonic() and
+# timestamp the wall clock datetime of the same poll
+Snapshot = collections.namedtuple('Snapshot',
+        ['ip', 'time', 'timestamp', 'status', 'temps', 'currents', 'singles', 'power'])
+
+class Gaps():
+    """ Interruptions of one data stream. A gap opens when the connection
+    is lost (or the first connect fails) and closes when data arrives
+    again; on_event is called with every closed gap.
+    """
+
+    def __init__(self, on_event = None):
+        self.on_event = on_event
+        self.events = []
+        self.total = 0.0
+        self.opened = None
+
+    def lost(self, reason):
+        if self.opened is None:
+            self.opened = (time.monotonic(), time.time(), str(reason))
+
+    def resumed(self):
+        if self.opened is None: return
+        t, wall, reason = self.opened
+        self.opened = None
+
+        event = {'lost': wall, 'duration': time.monotonic() - t, 'reason': reason}
+        self.events.append(event)
+        self.total += event['duration']
+        if self.on_event is not None:
+            self.on_event(event)
+
+    @property
+    def seconds(self):
+        """ total time lost, including a gap that is still open """
+        if self.opened is None: return self.total
+        return self.total + time.monotonic() - self.opened[0]
+
+    def close(self):
+        # a stream that never came back lost the rest of the run
+        self.resumed()
+
 class BackendAcq:
-    def __init__(self, ip, stop):
+    """ Iterate over chunks of the backend data stream
+
+    By default each chunk is a new bytes object and an empty chunk is
+    yielded on every receive timeout. With nbuffers > 0 the data is
+    received with recv_into over a ring of preallocated buffers instead,
+    and each chunk is a memoryview into the ring that stays valid until
+    nbuffers more chunks have been received; timeouts yield nothing.
+
+    A lost connection is retried at once, then with exponential backoff
+    until data flows again, and the interruption is recorded in gaps.
+    """
+
+    def __init__(self, ip, stop, port = data_port,
+                 recv_size = 8192, rcvbuf = None, nbuffers = 0, gaps = None):
         self.ip = ip
+        self.port = port
         self.stop = stop
         self.timeout = 0.1
         self.s = None
+        self.recv_size = recv_size
+        self.rcvbuf = rcvbuf
+        self.pool = [memoryview(bytearray(recv_size)) for _ in range(nbuffers)]
+        self.gaps = gaps or Gaps()
+        self.backoff = Backoff()
+
+    def lost(self, reason):
+        logging.debug(f'{self.ip}: Acquisition connection lost, {reason}')
+        self.gaps.lost(reason)
+        self.try_connect()
+
+    def received(self):
+        self.gaps.resumed()
+        self.backoff.reset()
 
     def try_connect(self):
         if isinstance(self.s, socket.socket):
             self.s.close()
+        self.s = None
+
+        delay = self.backoff.next()
+        if delay > 0 and self.stop.wait(delay):
+            return
 
         try:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.rcvbuf is not None:
+                self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
             self.s.settimeout(self.timeout)
-            self.s.connect((self.ip, data_port))
+            self.s.connect((self.ip, self.port))
             logging.debug(f'{self.ip}: Acquisition connected')
         except Exception as e:
             self.s = None
+            self.gaps.lost(e)
             logging.debug(f'{self.ip}: Acquisition failed to connect, {e}')
-            time.sleep(self.timeout)
 
     def __iter__(self):
+        if len(self.pool) > 0:
+            yield from self.iter_pool()
+            return
+
         while not self.stop.is_set():
+            if self.s is None:
+                self.try_connect()
+                yield b''
+                continue
+
             try:
-                yield self.s.recv(8192)
+                d = self.s.recv(self.recv_size)
             except TimeoutError:
                 yield b''
+                continue
             except Exception as e:
-                self.try_connect()
+                self.lost(e)
+                yield b''
+                continue
+
+            if len(d) == 0:
+                self.lost('connection closed by the backend')
                 yield b''
+                continue
 
-def acquire(ip, stop, sink, running = None):
+            self.received()
+            yield d
+
+    def iter_pool(self):
+        idx = 0
+        while not self.stop.is_set():
+            if self.s is None:
+                self.try_connect()
+                continue
+
+            buf = self.pool[idx]
+            try:
+                n = self.s.recv_into(buf)
+            except TimeoutError:
+                continue
+            except Exception as e:
+                self.lost(e)
+                continue
+
+            if n == 0:
+                self.lost('connection closed by the backend')
+                continue
+
+            self.received()
+            idx = (idx + 1) % len(self.pool)
+            yield buf[:n]
+
+class AcqStats():
+    """ Counters for the current (or last) acquisition of one backend:
+    bytes received from the network and, per sink, bytes delivered,
+    bytes dropped and seconds the receive loop (or a tee branch) was
+    blocked writing to it. Comparing these shows whether loss or stalls
+    came from the network, the disk or the sorter.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.received = 0
+        self.sinks = []
+        self.queues = {}
+        self.gaps = Gaps()
+
+    def add(self, name):
+        st = SinkStats(name)
+        self.sinks.append(st)
+        return st
+
+    def snapshot(self):
+        return {'received': self.received,
+                'elapsed': round(time.monotonic() - self.started, 3),
+                'gaps': len(self.gaps.events),
+                'gap_seconds': round(self.gaps.seconds, 3),
+                'sinks': {st.name: st.as_dict() for st in self.sinks}}
+
+def gap_sidecars(sink):
+    """ files that get a .gaps sidecar: every sink writing to a path, the
+    current one for a sink that rotates its files
+    """
+    if isinstance(sink, Tee):
+        return [p for b in sink.branches for p in gap_sidecars(b.sink)]
+    path = sink if isinstance(sink, str) else getattr(sink, 'path', None)
+    if isinstance(path, str) and path != os.devnull:
+        return [path + '.gaps']
+    return []
+
+def record_gap(ip, stats, sink, event):
+    """ log a closed gap, and append it to the sidecars of the files sink
+    is writing as a JSON line with the stream offset (bytes received
+    before the gap)
+    """
+    event = dict(event, offset = stats.received)
+    monitor_log.info(f'{ip} {datetime.now()} acquisition gap: {event}')
+    for path in gap_sidecars(sink):
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+        except OSError:
+            logging.exception(f'Failed to record gap in {path}')
+
+def acquire(ip, stop, sink, running = None, reactor = None,
+            port = data_port, stats = None, **acq_opts):
     if running is None:
         running = threading.Event()
 
@@ -52,67 +231,144 @@ def acquire(ip, stop, sink, running = None):
         # acquisition should be disabled
         return
 
-    acq_inst = BackendAcq(ip, stop)
+    if isinstance(sink, (list, tuple)):
+        # several sinks, each fed from its own queue
+        sink = Tee(sink)
+
+    if stats is None:
+        stats = AcqStats()
+    stats.reset()
+
+    stats.gaps.on_event = lambda e: record_gap(ip, stats, sink, e)
+
+    if reactor is None:
+        acq_inst = BackendAcq(ip, stop, port, gaps = stats.gaps, **acq_opts)
+    else:
+        acq_inst = reactor.data_stream(ip, port, stop, gaps = stats.gaps)
     running.set()
 
     monitor_log.info(f'{ip} {datetime.now()} acquisition: start')
 
     if isinstance(sink, str):
+        # written by its own thread, so a slow disk doesn't stall the receive
         logging.debug(f'Create new ACQ worker thread to {sink}')
-        with open(sink, 'wb') as f:
-            for d in acq_inst:
-                f.write(d)
+        name = sink
+        ctx = FileWriter(sink)
+        put = ctx.write
 
     elif isinstance(sink, socket.socket):
         logging.debug('Start online coincidence sorting')
-        for d in acq_inst:
-            sink.sendall(d)
-        logging.debug('End online coincidence sorting')
-        sink.close()
+        name = 'socket'
+        ctx = sink
+        put = sink.sendall
+
+    elif hasattr(sink, 'write'):
+        logging.debug(f'Create new ACQ worker thread to {sink}')
+        name = repr(sink)
+        ctx = sink
+        put = sink.write
 
     else: # sink should be queue
         logging.debug(f'Create new ACQ worker thread to UI')
+        name = 'queue'
+        ctx = contextlib.nullcontext()
+        # pooled chunks are reused, so hand the UI its own copy
+        put = lambda d: sink.put_nowait(bytes(d) if isinstance(d, memoryview) else d)
+
+    if isinstance(sink, Tee):
+        # the tee only enqueues, its branches account for each sink
+        name = 'tee'
+        stats.sinks.extend(sink.stats)
+        stats.queues = {b.stats.name: b.chunks for b in sink.branches}
+    st = stats.add(name)
+
+    failed = False
+    with ctx:
         for d in acq_inst:
+            if len(d) == 0: continue
+            stats.received += len(d)
+            if failed:
+                st.dropped += len(d)
+                continue
+
+            t = time.perf_counter()
             try:
-                sink.put_nowait(d)
-            except queue.Full: pass
+                put(d)
+                st.delivered += len(d)
+            except queue.Full:
+                st.dropped += len(d)
+            except OSError:
+                # e.g. the disk is full, the rest of the run is dropped
+                failed = True
+                st.dropped += len(d)
+                logging.exception(f'{ip}: writing to {name} failed, dropping further data')
+            st.blocked += time.perf_counter() - t
+
+    if isinstance(sink, socket.socket):
+        logging.debug('End online coincidence sorting')
 
-    monitor_log.info(f'{ip} {datetime.now()} acquisition: stop')
+    stats.gaps.close()
+    monitor_log.info(f'{ip} {datetime.now()} acquisition: stop, '
+                     f'{len(stats.gaps.events)} gaps, {round(stats.gaps.total, 3)} s lost')
 
 class Backend():
     def __getattr__(self, attr):
         return lambda *args, **kwds: [getattr(f, attr)(*args, **kwds) for f in self.frontend]
 
-    def __init__(self, ip):
+    def __init__(self, ip, reactor = None, acq_opts = None, ports = None,
+                 monitor = True):
+        """ with monitor unset no monitor thread is started, the owner
+        polls snapshot() itself (see telemetry.Telemetry)
+        """
         self.ip = ip
-        self.gx = Gigex(ip)
+        self.monitor = monitor
+        self.reactor = reactor
+        self.gx = Gigex(ip, reactor, ports)
+        self.gx.on_reset.append(self.invalidate)
+
+        # receive options passed on to BackendAcq
+        self.acq_opts = dict(acq_opts or {})
+        self.acq_opts['port'] = (ports or {}).get('data_port', data_port)
         self.frontend = [Frontend(self, i) for i in range(4)]
 
+        # cached module power states, None until first read or written
+        self.power_state = None
+
         self.exit = threading.Event()
         self.dest = queue.Queue()
+        self.acq_closed = threading.Event() # set whenever a sink has been closed
+        self.acq_stats = AcqStats()
 
         self.ui_mon_queue = queue.Queue()
-        self.ui_data_queue = queue.Queue(maxsize = 10)
+        self.ui_preview = Preview()
+        self.last_received = (time.monotonic(), 0)
 
     def __enter__(self):
         self.gx.start()
+        self.ui_preview.start()
+        metrics.registry.collector(self.collect_metrics)
         self.acq_management_thread = threading.Thread(target = self.acq)
-        self.monitor_thread = threading.Thread(target = self.mon)
         self.acq_management_thread.start()
-        self.monitor_thread.start()
+        if self.monitor:
+            self.monitor_thread = threading.Thread(target = self.mon)
+            self.monitor_thread.start()
         return self
 
     def __exit__(self, *context):
         self.exit.set()
         self.dest.put(None)
-        self.monitor_thread.join()
+        if self.monitor:
+            self.monitor_thread.join()
         self.acq_management_thread.join()
+        self.ui_preview.stop()
+        metrics.registry.remove_collector(self.collect_metrics)
         self.gx.stop()
 
     def acq(self):
         acq_stop = threading.Event()
         acq_thread = threading.Thread(target = acquire,
-                args = [self.ip, acq_stop, self.ui_data_queue])
+                args = [self.ip, acq_stop, self.ui_preview],
+                kwargs = {'reactor': self.reactor, 'stats': self.acq_stats, **self.acq_opts})
         acq_thread.start()
 
         while True:
@@ -121,54 +377,156 @@ class Backend():
             acq_stop.set()
             acq_thread.join()
             acq_stop.clear()
+            self.acq_closed.set()
 
             if vals is None: break
 
             acq_thread = threading.Thread(target = acquire,
-                    args = [self.ip, acq_stop, *vals])
+                    args = [self.ip, acq_stop, *vals],
+                    kwargs = {'reactor': self.reactor, 'stats': self.acq_stats, **self.acq_opts})
             acq_thread.start()
 
     def mon(self, interval = 10.0):
         while True:
-            if self.get_status():
-                temps = self.get_all_temps()
-                currs = self.get_current()
-                sgls  = self.get_counter(0, div = 3)
-                self.ui_mon_queue.put((temps, currs, sgls))
-
-                now = datetime.now()
-                monitor_log.info(f'{self.ip} {now} current: {currs}')
-                monitor_log.info(f'{self.ip} {now} temperature: {temps}')
-                monitor_log.info(f'{self.ip} {now} singles: {sgls}')
-
+            self.mon_sweep()
             if self.exit.wait(interval):
                 return
 
+    def mon_sweep(self):
+        snap = self.snapshot()
+        self.publish(snap)
+        if not snap.status:
+            return None
+        return snap.temps, snap.currents, snap.singles
+
+    def telemetry_plan(self, counter_div = 3):
+        """ every command word of a monitor reading, so the whole
+        snapshot is one pipelined round trip
+        """
+        return ([cmd.backend_status(10)] +
+                [c for f in self.frontend for c in f.temp_cmds()] +
+                [cmd.get_current(m) for m in range(4)] +
+                [cmd.backend_counter(m, 0, counter_div) for m in range(4)] +
+                [cmd.set_power(False, [False]*4)])
+
+    def snapshot(self, counter_div = 3):
+        n = len(temp_channels)
+        plan = self.telemetry_plan(counter_div)
+        t = time.perf_counter()
+        now, timestamp = time.monotonic(), datetime.now()
+
+        try:
+            resp = self.gx.send_many(plan, return_exceptions = True)
+        except Exception as e:
+            logging.debug(f'{self.ip}: telemetry poll failed, {e}')
+            resp = [e] * len(plan)
+
+        status = resp[0] == plan[0]
+        if not status:
+            # the rest of the batch is not trusted without a status reply
+            resp = [-1] * len(plan)
+
+        temps = [adc_to_temp(r) for r in resp[1:1+4*n]]
+        temps = [temps[i:i+n] for i in range(0, len(temps), n)]
+        value = lambda r, shift = 0: -1 if isinstance(r, Exception) or r < 0 else cmd.payload(r) << shift
+        currs = [value(r) for r in resp[1+4*n:5+4*n]]
+        sgls  = [value(r, counter_div) for r in resp[5+4*n:9+4*n]]
+
+        # the power read keeps the cache right when the hardware itself
+        # turns a module off, e.g. over temperature or current
+        power = None
+        if isinstance(resp[-1], int) and resp[-1] >= 0:
+            power = self.update_power(cmd.mask_to_bool(cmd.payload(resp[-1])))
+
+        metrics.sweep_seconds.observe(time.perf_counter() - t, ip = self.ip)
+        return Snapshot(self.ip, now, timestamp, status, temps, currs, sgls, power)
+
+    def publish(self, snap):
+        """ hand a snapshot to the UI and the monitor log """
+        if not snap.status:
+            return
+
+        self.ui_mon_queue.put((snap.temps, snap.currents, snap.singles))
+        monitor_log.info(f'{self.ip} {snap.timestamp} current: {snap.currents}')
+        monitor_log.info(f'{self.ip} {snap.timestamp} temperature: {snap.temps}')
+        monitor_log.info(f'{self.ip} {snap.timestamp} singles: {snap.singles}')
+        monitor_log.info(f'{self.ip} {snap.timestamp} acquisition stats: {self.get_acq_stats()}')
+
+    def collect_metrics(self):
+        st = self.acq_stats
+        now = time.monotonic()
+        t, received = self.last_received
+        if st.received >= received and now > t:
+            metrics.acq_throughput.set((st.received - received) / (now - t), ip = self.ip)
+        self.last_received = (now, st.received)
+
+        metrics.acq_received.set(st.received, ip = self.ip)
+        for s in list(st.sinks):
+            metrics.acq_delivered.set(s.delivered, ip = self.ip, sink = s.name)
+            metrics.acq_dropped.set(s.dropped, ip = self.ip, sink = s.name)
+            metrics.acq_blocked.set(s.blocked, ip = self.ip, sink = s.name)
+
+        queues = {'command': self.gx.queue_in, 'info': self.gx.info_queue,
+                  'dest': self.dest, 'ui_mon': self.ui_mon_queue,
+                  'preview': self.ui_preview.chunks, **st.queues}
+        for name, q in queues.items():
+            metrics.queue_depth.set(q.qsize(), ip = self.ip, queue = name)
+
+    def get_acq_stats(self):
+        """ counters of the running acquisition, see AcqStats """
+        return self.acq_stats.snapshot()
+
     @ignore_network_errors(False)
     def get_status(self):
         c = cmd.backend_status(10)
         return self.gx.send(c) == c
 
+    def invalidate(self):
+        """ forget every cached state, e.g. after a reboot """
+        self.power_state = None
+        [f.invalidate() for f in self.frontend]
+
+    def update_power(self, states):
+        # a module that changed power state loses its DAC values
+        old = self.power_state or [None]*4
+        for f, before, after in zip(self.frontend, old, states):
+            if before != after: f.invalidate()
+
+        self.power_state = list(states)
+        return list(states)
+
     @ignore_network_errors([True]*4)
-    def get_power(self):
+    def get_power(self, verify = False):
+        if self.power_state is not None and not verify:
+            return list(self.power_state)
+
         resp = self.gx.send(cmd.set_power(False, [False]*4))
-        return cmd.mask_to_bool(cmd.payload(resp))
+        return self.update_power(cmd.mask_to_bool(cmd.payload(resp)))
 
     @ignore_network_errors([True]*4)
     def set_power(self, state = [False]*4):
         resp = self.gx.send(cmd.set_power(True, state))
-        return cmd.mask_to_bool(cmd.payload(resp))
+        return self.update_power(cmd.mask_to_bool(cmd.payload(resp)))
 
     @ignore_network_errors([-1]*4)
     def get_current(self):
-        resp = [self.gx.send(cmd.get_current(m)) for m in range(4)]
+        resp = self.gx.send_many([cmd.get_current(m) for m in range(4)])
         return [cmd.payload(m) for m in resp]
 
     @ignore_network_errors([-1]*4)
     def get_counter(self, ch, div = 0):
-        resp = [self.gx.send(cmd.backend_counter(m,ch,div)) for m in range(4)]
+        resp = self.gx.send_many([cmd.backend_counter(m,ch,div) for m in range(4)])
         return [cmd.payload(r) << div for r in resp]
 
+    @ignore_network_errors([[-1]*len(temp_channels)]*4)
+    def get_all_temps(self):
+        # read every thermistor on every frontend in a single round trip
+        n = len(temp_channels)
+        cmds = [c for f in self.frontend for c in f.temp_cmds()]
+        resp = self.gx.send_many(cmds, return_exceptions = True)
+        temps = [adc_to_temp(r) for r in resp]
+        return [temps[i:i+n] for i in range(0, len(temps), n)]
+
     @ignore_network_errors(None)
     def set_backend_otp_ocp(self, value = True):
         c = cmd.backend_reg_update(value,value)
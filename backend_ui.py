@@ -3,12 +3,18 @@ import tkinter as tk
 from frontend_ui import FrontendUI
 from frontend import temp_channels
 
+bars = ' ▁▂▃▄▅▆▇█'
+
+def sparkline(vals):
+    top = max(vals) or 1
+    return ''.join(bars[round(v / top * (len(bars) - 1))] for v in vals)
+
 class BackendUI():
     def __init__(self, backend_instance, status_frame, acq_frame, acq_counts_frame):
         self.backend = backend_instance
         self.status_frame = tk.Frame(status_frame)
 
-        self.ui_data_interval_ms = 100
+        self.ui_data_interval_ms = 500
         self.ui_mon_interval_ms = 1000
         self.data = tk.Text(acq_frame, height = 4, takefocus = False)
 
@@ -39,6 +45,7 @@ class BackendUI():
             self.frontend.append(FrontendUI(fe, self.m_frame[-1]))
 
         self.temps = [-1]
+        self.shown = None
         self.check_mon_queue()
         self.check_data_queue()
 
@@ -79,8 +86,13 @@ class BackendUI():
             self.data.after(self.ui_data_interval_ms,
                     self.check_data_queue)
 
-        try:
-            d = self.backend.ui_data_queue.get_nowait()
-            self.data.delete(1.0, 'end')
-            self.data.insert('end', str(d) + "\n")
-        except queue.Empty: pass
+        summ = self.backend.ui_preview.latest()
+        if summ is None or summ is self.shown:
+            return
+
+        self.shown = summ
+        rates = ' '.join(f'M{i} {round(r/1e3):,}K/s' for i, r in enumerate(summ.module_rates))
+        self.data.delete(1.0, 'end')
+        self.data.insert('end', f'{summ.bytes_per_s/1e6:.2f} MB/s   {rates}   '
+                                f'commands {summ.command_fraction:.1%}\n')
+        self.data.insert('end', sparkline(summ.histogram) + "\n")
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+# Transport and acquisition benchmarks against the loopback simulator.
+# Run from the repository root:
+#
+#   python -m benchmarks.run -o bench.json
+#
+# Every result is written to a single JSON document so runs can be diffed
+# against each other whenever gigex, reactor or the acquisition path change.
+
+import sys, os, time, json, queue, socket, threading, tempfile, argparse
+import platform, statistics, logging
+from datetime import datetime
+
+import command as cmd
+import backend
+from gigex import Gigex
+from reactor import Reactor
+from system import System
+from sinks import FileWriter
+from simulator import SimDevice, SimSystem, sim_sync_ip, sim_backend_ips
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'n':    len(samples),
+            'mean': statistics.fmean(samples),
+            'p50':  pick(0.50),
+            'p90':  pick(0.90),
+            'p99':  pick(0.99),
+            'max':  samples[-1]}
+
+def timed(fun, n):
+    samples = []
+    for _ in range(n):
+        t = time.perf_counter()
+        fun()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+class cpu_time():
+    """ process CPU seconds (all threads) spent inside the block """
+    def __enter__(self):
+        self.start = time.process_time()
+        return self
+
+    def __exit__(self, *context):
+        self.seconds = time.process_time() - self.start
+
+def bench_send(n, reactor):
+    """ Gigex.send round trip and send_many batch latency """
+    ip = sim_backend_ips[0]
+    with SimDevice(ip, data_rate = 1e3) as dev:
+        dev.bank0 = 0xF << 4 # all modules powered
+        rx = Reactor() if reactor else None
+        if rx is not None: rx.start()
+
+        gx = Gigex(ip, rx)
+        gx.start()
+        try:
+            c = cmd.backend_status(10)
+            [gx.send(c) for _ in range(100)]
+
+            with cpu_time() as cpu:
+                single = timed(lambda: gx.send(c), n)
+
+            temps = [cmd.adc_read(m, ch) for m in range(4) for ch in range(8)]
+            serial = timed(lambda: [gx.send(t) for t in temps], max(1, n // 32))
+            batch = timed(lambda: gx.send_many(temps), max(1, n // 32))
+        finally:
+            gx.stop()
+            if rx is not None: rx.stop()
+
+    return {'send':            percentiles(single),
+            'send_cpu_per_cmd': cpu.seconds / n,
+            'sweep32_send':     percentiles(serial),
+            'sweep32_send_many': percentiles(batch)}
+
+def bench_system(n, reactor):
+    """ System.sys_status wall time and Backend.mon_sweep time """
+    with SimSystem(data_rate = 1e3):
+        sys = System(reactor = reactor, sync_ip = sim_sync_ip,
+                     backend_ips = sim_backend_ips)
+        with sys:
+            sys.set_power([[True]*4]*4)
+            q = queue.Queue()
+
+            def status():
+                sys.sys_status(q)
+                q.get()
+
+            with cpu_time() as cpu:
+                stat = timed(status, n)
+
+            be = sys.backend[0]
+            mon = timed(be.mon_sweep, n)
+
+    return {'sys_status':         percentiles(stat),
+            'sys_status_cpu':     cpu.seconds / n,
+            'mon_sweep':          percentiles(mon)}
+
+def drain_socket(s, counter):
+    while True:
+        d = s.recv(1 << 16)
+        if len(d) == 0: break
+        counter[0] += len(d)
+
+def drain_queue(q, counter, stop):
+    while not stop.is_set():
+        try:
+            counter[0] += len(q.get(timeout = 0.1))
+        except queue.Empty: pass
+
+def bench_acquire(duration, sink_type, reactor, acq_opts):
+    """ sustained bytes/s from the data port into one sink """
+    ip = sim_backend_ips[0]
+    counter = [0]
+    stop = threading.Event()
+    drain_stop = threading.Event()
+    rx = Reactor() if reactor else None
+
+    with SimDevice(ip, data_rate = None), tempfile.TemporaryDirectory() as tmp:
+        if rx is not None: rx.start()
+
+        path = os.path.join(tmp, 'bench.SGL')
+        if sink_type == 'file':
+            sink = path
+            drain = None
+        elif sink_type == 'writer':
+            sink = FileWriter(path, fsync = 'never')
+            drain = None
+        elif sink_type == 'socket':
+            sink, peer = socket.socketpair()
+            drain = threading.Thread(target = drain_socket, args = [peer, counter])
+        else:
+            sink = queue.Queue(maxsize = 10)
+            drain = threading.Thread(target = drain_queue,
+                    args = [sink, counter, drain_stop])
+
+        if drain is not None: drain.start()
+
+        running = threading.Event()
+        thr = threading.Thread(target = backend.acquire,
+                args = [ip, stop, sink, running], kwargs = {'reactor': rx, **acq_opts})
+
+        with cpu_time() as cpu:
+            thr.start()
+            running.wait()
+            time.sleep(duration)
+            stop.set()
+            thr.join()
+
+        drain_stop.set()
+        if drain is not None: drain.join()
+        if sink_type in ['file', 'writer']:
+            counter[0] = os.path.getsize(path)
+
+        if rx is not None: rx.stop()
+
+    return {'bytes':           counter[0],
+            'bytes_per_s':     counter[0] / duration,
+            'cpu_per_s':       cpu.seconds / duration}
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark command and acquisition paths')
+    parser.add_argument('-o', '--output', help = 'JSON output file, default stdout')
+    parser.add_argument('-n', type = int, default = 2000, help = 'commands per latency run')
+    parser.add_argument('-d', '--duration', type = float, default = 3.0,
+            help = 'seconds per throughput run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.WARNING)
+
+    results = {}
+    for mode in ['threaded', 'reactor']:
+        reactor = mode == 'reactor'
+        results[f'transport_{mode}'] = bench_send(args.n, reactor)
+        results[f'system_{mode}'] = bench_system(max(1, args.n // 100), reactor)
+
+        for sink in ['file', 'writer', 'socket', 'queue']:
+            results[f'acquire_{sink}_{mode}'] = bench_acquire(
+                    args.duration, sink, reactor, {})
+
+    for sink in ['file', 'writer', 'socket', 'queue']:
+        results[f'acquire_{sink}_pool'] = bench_acquire(args.duration, sink, False,
+                {'recv_size': 1 << 18, 'rcvbuf': 1 << 22, 'nbuffers': 16})
+
+    report = {'timestamp': datetime.now().isoformat(),
+              'python':    platform.python_version(),
+              'machine':   platform.machine(),
+              'results':   results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+if __name__ == "__main__":
+    main()
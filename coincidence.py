@@ -0,0 +1,208 @@
+import queue, threading, logging, subprocess, time
+import numpy as np
+import sgl
+
+# In-process online coincidence sorter, an alternative to the external
+# sorter binary. Each backend stream is fed through its own input sink,
+# a worker thread decodes the singles times block by block and merges
+# the streams with vectorized time window matching. The records below are
+# its own format, not the sorter binary's online.COIN, and the singles
+# times rely on the sgl time layout, so it is opt-in (System builtin_sorter).
+
+# Output records, one per coincident pair in time order
+coin_dtype = np.dtype([('time', '>u8'),     # fine clock ticks of the first single
+                       ('backend_a', 'u1'),
+                       ('backend_b', 'u1'),
+                       ('dt', '>u2'),       # ticks between the two singles
+                       ('single_a', '>u4'),
+                       ('single_b', '>u4')])
+
+class SorterInput():
+    """ acquire() sink for one backend stream """
+
+    def __init__(self, sorter, idx):
+        self.sorter = sorter
+        self.idx = idx
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'SorterInput({self.idx})'
+
+    def write(self, data):
+        if len(data) > 0 and self.sorter.thr.is_alive():
+            self.sorter.chunks.put((self.idx, bytes(data)))
+
+    def close(self):
+        self.sorter.chunks.put((self.idx, None))
+
+class CoincidenceSorter():
+    """ Sort n backend streams into coincident pairs written to path
+
+    Singles closer than window ticks, from different backends and with no
+    third single inside the window, are paired. Events are only matched
+    once every open stream has reached the same time (the watermark), a
+    stream that lags by more than max_pending singles is left out of the
+    watermark so one quiet backend can't hold back the others.
+
+    Streams are matched whenever the decoded backlog has been worked off,
+    and under sustained input at least every merge_interval seconds or
+    merge_singles decoded singles, so the pending singles stay bounded.
+
+    wait() and kill() mirror subprocess.Popen, so the sorter can stand in
+    for the external binary.
+    """
+
+    def __init__(self, path, n = 4, window = 20, timing = sgl.event_times,
+                 max_pending = 1 << 22, merge_singles = 1 << 20, merge_interval = 0.5):
+        self.path = path
+        self.n = n
+        self.window = window
+        self.timing = timing
+        self.max_pending = max_pending
+        self.merge_singles = merge_singles
+        self.merge_interval = merge_interval
+
+        self.inputs = [SorterInput(self, i) for i in range(n)]
+        self.chunks = queue.Queue(maxsize = 256)
+
+        self.open = [True] * n
+        self.leftover = [b''] * n
+        self.coarse = [0] * n
+        self.pending = [self.empty() for _ in range(n)]
+
+        self.singles = 0
+        self.unmerged = 0
+        self.last_merge = time.monotonic()
+        self.coincidences = 0
+        self.killed = threading.Event()
+
+        self.out = open(path, 'wb')
+        self.thr = threading.Thread(target = self.run)
+        self.thr.start()
+
+    @staticmethod
+    def empty():
+        return (np.zeros(0, np.uint64), np.zeros(0, np.uint8), np.zeros(0, np.uint32))
+
+    def input(self, idx):
+        return self.inputs[idx]
+
+    def wait(self, timeout = None):
+        self.thr.join(timeout)
+        if self.thr.is_alive():
+            raise subprocess.TimeoutExpired('coincidence sorter', timeout)
+        return 0
+
+    def kill(self):
+        self.killed.set()
+        self.thr.join()
+
+    def run(self):
+        try:
+            while any(self.open) and not self.killed.is_set():
+                try:
+                    idx, data = self.chunks.get(timeout = 0.1)
+                except queue.Empty:
+                    continue
+
+                if data is None:
+                    self.open[idx] = False
+                else:
+                    self.decode(idx, data)
+
+                # match block-wise, whenever the backlog has been decoded
+                # or enough has piled up while it never is
+                if (self.chunks.empty() or not any(self.open) or
+                        self.unmerged >= self.merge_singles or
+                        time.monotonic() - self.last_merge >= self.merge_interval):
+                    self.merge(final = not any(self.open))
+                    self.unmerged = 0
+                    self.last_merge = time.monotonic()
+        finally:
+            self.out.close()
+            # unblock any input still waiting on a full queue
+            while not self.chunks.empty():
+                self.chunks.get_nowait()
+            logging.info(f'Coincidence sorter: {self.singles} singles, '
+                         f'{self.coincidences} coincidences')
+
+    def decode(self, idx, data):
+        data = self.leftover[idx] + data
+        nbytes = len(data) - (len(data) % 4)
+        self.leftover[idx] = data[nbytes:]
+
+        words = np.frombuffer(data, dtype = '>u4', count = nbytes // 4).astype(np.uint32)
+        times, singles, self.coarse[idx] = self.timing(words, self.coarse[idx])
+        self.singles += len(times)
+        self.unmerged += len(times)
+
+        t, b, w = self.pending[idx]
+        self.pending[idx] = (np.concatenate([t, times]),
+                             np.concatenate([b, np.full(len(times), idx, np.uint8)]),
+                             np.concatenate([w, singles]))
+
+    def merge(self, final = False):
+        lengths = [len(p[0]) for p in self.pending]
+
+        if final:
+            watermark = np.iinfo(np.uint64).max
+        else:
+            heads = [int(p[0][-1]) for p, o in zip(self.pending, self.open)
+                     if o and len(p[0]) > 0]
+            idle = any(o and l == 0 for o, l in zip(self.open, lengths))
+            if len(heads) == 0 or (idle and max(lengths) < self.max_pending):
+                return
+            watermark = min(heads)
+
+        # every single before the watermark is final, pairs are only
+        # accepted well before it so a partner can't still be in flight
+        ready = [p[0] < watermark for p in self.pending]
+        t = np.concatenate([p[0][r] for p, r in zip(self.pending, ready)])
+        if len(t) == 0: return
+
+        b = np.concatenate([p[1][r] for p, r in zip(self.pending, ready)])
+        w = np.concatenate([p[2][r] for p, r in zip(self.pending, ready)])
+        self.pending = [tuple(a[~r] for a in p) for p, r in zip(self.pending, ready)]
+
+        order = np.argsort(t, kind = 'stable')
+        t, b, w = t[order], b[order], w[order]
+
+        dt = np.diff(t)
+        close = dt <= self.window
+        before = np.concatenate([[False], close[:-1]])
+        after = np.concatenate([close[1:], [False]])
+        pair = close & ~before & ~after & (b[:-1] != b[1:])
+
+        cut = watermark if final else max(0, watermark - 2 * self.window)
+        pair &= t[:-1] < cut
+        i = np.nonzero(pair)[0]
+
+        rec = np.zeros(len(i), dtype = coin_dtype)
+        rec['time'] = t[i]
+        rec['backend_a'] = b[i]
+        rec['backend_b'] = b[i+1]
+        rec['dt'] = dt[i]
+        rec['single_a'] = w[i]
+        rec['single_b'] = w[i+1]
+        self.out.write(rec.tobytes())
+        self.coincidences += len(rec)
+
+        if not final:
+            # singles near the watermark that were not paired are matched
+            # again with the next block
+            used = np.zeros(len(t), bool)
+            used[i] = True
+            used[i+1] = True
+            carry = (t >= cut) & ~used
+            for idx in range(self.n):
+                sel = carry & (b == idx)
+                if not sel.any(): continue
+                pt, pb, pw = self.pending[idx]
+                self.pending[idx] = (np.concatenate([t[sel], pt]),
+                                     np.concatenate([b[sel], pb]),
+                                     np.concatenate([w[sel], pw]))
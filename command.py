@@ -30,6 +30,17 @@ CMD_RESPONSE    = 0xF
 
 CMD_EMPTY = 0xF0000000
 
+# Control words of the local command server (Sync), never sent to a
+# device. ROUTE in bits 28:31 selects the device for the following
+# commands: 0 is the sync board, 1 to 4 the backends.
+ROUTE = 0x1
+
+def route(device):
+    return (ROUTE << 28) | (device & 0xFFFFFFF)
+
+def is_route(cmd_int):
+    return (cmd_int >> 28) == ROUTE
+
 def payload(cmd_int):
     return cmd_int & 0xFFFFF
 
@@ -86,6 +97,10 @@ def rst_hard():
                         mask   = 1,
                         value  = 1)
 
+def is_reset(cmd_int):
+    """ rst_soft or rst_hard, after which cached backend state is stale """
+    return cmd_int in (rst_soft(True), rst_soft(False), rst_hard())
+
 def set_power(update = False, pwr_states = [False]*4):
     """ read or write the bits 4:7 of bank 0 to set the power state """
     bits = bool_to_mask(pwr_states[0:4])
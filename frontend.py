@@ -62,6 +62,7 @@ def res_to_temp(R, R0 = 10000, T0 = 298.15, B = 3900):
         return 0
 
 def adc_to_temp(adc_val):
+    if isinstance(adc_val, Exception): return -1
     if adc_val < 0: return adc_val
     voltage = ((adc_val & 0xFFF) / 0x7FF) * 2.048
     resistance = voltage_to_res(voltage)
@@ -72,6 +73,21 @@ class Frontend():
         self.backend = backend_instance
         self.index = index
 
+        # write-through cache of the DAC registers (by channel) and the
+        # module id, cleared when the module is reset or power cycled
+        self.dac_cache = {}
+        self.physical_idx = None
+
+    def invalidate(self):
+        self.dac_cache.clear()
+        self.physical_idx = None
+
+    def verified(self, name, cached, actual):
+        if cached is not None and cached != actual:
+            logging.warning(f'{self.backend.ip} module {self.index}: cached {name} '
+                            f'{cached} does not match hardware {actual}')
+        return actual
+
     @ignore_network_errors([-1]*4)
     def set_bias(self, value = 0.0):
         values = []
@@ -88,8 +104,8 @@ class Frontend():
         return values
 
     @ignore_network_errors([-1]*4)
-    def get_bias(self):
-        return [hex_to_bias(self.get_dac(True, i)) for i in range(4)]
+    def get_bias(self, verify = False):
+        return [hex_to_bias(v) for v in self.get_all_dac(True, verify)]
 
     @ignore_network_errors([-1]*4)
     def set_thresh(self, value = 0.05):
@@ -102,8 +118,8 @@ class Frontend():
         return values
 
     @ignore_network_errors([-1]*4)
-    def get_thresh(self):
-        return [hex_to_thresh(self.get_dac(False, i)) for i in range(4)]
+    def get_thresh(self, verify = False):
+        return [hex_to_thresh(v) for v in self.get_all_dac(False, verify)]
 
     @ignore_network_errors(-1)
     def set_dac(self, is_bias, block, value):
@@ -112,14 +128,33 @@ class Frontend():
 
         cmd = command.dac_write(self.index, ch, val)
         ret = self.backend.gx.send(cmd)
+        self.dac_cache[ch] = command.payload(ret)
         return command.payload(ret)
 
     @ignore_network_errors(-1)
-    def get_dac(self, is_bias, block):
+    def get_dac(self, is_bias, block, verify = False):
         ch = bias_ch[block] if is_bias else thresh_ch[block]
+        cached = self.dac_cache.get(ch)
+        if cached is not None and not verify:
+            return cached
+
         cmd = command.dac_read(self.index, ch)
         ret = self.backend.gx.send(cmd)
-        return command.payload(ret)
+        self.dac_cache[ch] = self.verified('DAC', cached, command.payload(ret))
+        return self.dac_cache[ch]
+
+    def get_all_dac(self, is_bias, verify = False):
+        chs = [(bias_ch if is_bias else thresh_ch)[i] for i in range(4)]
+        cached = [self.dac_cache.get(ch) for ch in chs]
+        if None not in cached and not verify:
+            return cached
+
+        cmds = [command.dac_read(self.index, ch) for ch in chs]
+        ret = self.backend.gx.send_many(cmds)
+        vals = [command.payload(r) for r in ret]
+        for ch, c, v in zip(chs, cached, vals):
+            self.dac_cache[ch] = self.verified('DAC', c, v)
+        return vals
 
     @ignore_network_errors(-1)
     def get_temp(self, adc_ch):
@@ -127,14 +162,23 @@ class Frontend():
         ret = self.backend.gx.send(cmd)
         return adc_to_temp(ret)
 
+    def temp_cmds(self):
+        return [command.adc_read(self.index, ch) for ch in temp_channels.values()]
+
+    @ignore_network_errors([-1]*len(temp_channels))
     def get_all_temps(self):
-        return [self.get_temp(ch) for ch in temp_channels.values()]
+        ret = self.backend.gx.send_many(self.temp_cmds(), return_exceptions = True)
+        return [adc_to_temp(r) for r in ret]
 
     @ignore_network_errors(-1)
-    def get_physical_idx(self):
+    def get_physical_idx(self, verify = False):
+        if self.physical_idx is not None and not verify:
+            return self.physical_idx
+
         cmd = command.module_id(self.index)
         ret = self.backend.gx.send(cmd)
-        return command.module(ret)
+        self.physical_idx = self.verified('module id', self.physical_idx, command.module(ret))
+        return self.physical_idx
 
     @ignore_network_errors(-1)
     def get_current(self):
@@ -155,13 +199,15 @@ class Frontend():
 
     @ignore_network_errors([-1]*4)
     def get_all_singles_rates(self, divisor = 0):
-        return [self.get_singles_rate(i, divisor) for i in range(4)]
+        cmds = [command.singles_rate_read(self.index, i, divisor) for i in range(4)]
+        ret = self.backend.gx.send_many(cmds)
+        return [command.payload(r) for r in ret]
 
     @ignore_network_errors(None)
     def frontend_reset(self):
         cmd = command.frontend_rst(self.index)
-        with self.backend.gx:
-            self.backend.gx.spi(cmd)
+        self.invalidate()
+        self.backend.gx.spi(cmd)
 
     @ignore_network_errors(-1)
     def tt_stall_disable(self, disable = True):
@@ -1,9 +1,14 @@
 import time, socket, threading, logging, queue
+from concurrent.futures import TimeoutError as FutureTimeout
 import command as cmd
+import metrics
 
 class ModuleNotPowered(Exception): pass
 
-NetworkErrors = (TimeoutError, ConnectionRefusedError, OSError)
+class Desync(Exception):
+    """ a response that can't be the reply to the command that was sent """
+
+NetworkErrors = (TimeoutError, ConnectionRefusedError, OSError, Desync)
 
 sys_port = 0x5001
 cmd_port = 5556
@@ -35,6 +40,84 @@ def flush(s):
             s.settimeout(timeout)
             return
 
+def drain(s, quiet, until = None):
+    """ discard everything received until nothing arrives for quiet
+    seconds, or until the time.monotonic() value until has passed
+    """
+    timeout = s.gettimeout()
+    try:
+        while True:
+            wait = quiet
+            if until is not None:
+                wait = min(wait, until - time.monotonic())
+                if wait <= 0: break
+            s.settimeout(wait)
+            if len(s.recv(1024)) == 0: break
+    except TimeoutError: pass
+    finally:
+        s.settimeout(timeout)
+
+class RttEstimator():
+    """ Adaptive command timeout from the measured round trip times, as
+    TCP does (RFC 6298): smoothed rtt plus four times its variation,
+    doubled after every timeout until a new sample arrives
+    """
+
+    def __init__(self, initial = 0.1, min_timeout = 0.02, max_timeout = 1.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+    @property
+    def timeout(self):
+        return min(max(self.rto, self.min_timeout), self.max_timeout)
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = self.srtt + 4 * self.rttvar
+
+    def backoff(self):
+        self.rto = min(2 * self.timeout, self.max_timeout)
+
+class Backoff():
+    """ reconnect delays: the first retry is immediate, later ones wait
+    first, 2*first, 4*first ... up to max_delay seconds, until reset()
+    """
+
+    def __init__(self, first = 0.01, max_delay = 0.5):
+        self.first = first
+        self.max_delay = max_delay
+        self.attempt = 0
+
+    def next(self):
+        delay = 0.0 if self.attempt == 0 else min(
+                self.first * 2 ** (self.attempt - 1), self.max_delay)
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+# commands whose reply carries a different module field (the physical index)
+unchecked_module = [cmd.MODULE_ID]
+
+def check_response(cmd_int, resp):
+    if isinstance(resp, Exception) or not cmd.is_command(cmd_int):
+        return resp
+
+    c = cmd.command(cmd_int)
+    if (cmd.command(resp) != c or
+            (c not in unchecked_module and cmd.module(resp) != cmd.module(cmd_int))):
+        raise Desync(f'Response {hex(resp)} does not match command {hex(cmd_int)}')
+
+    return resp
+
 def connect(s, ip, port, timeout = None):
     if isinstance(s, socket.socket):
         s.close()
@@ -46,10 +129,17 @@ def connect(s, ip, port, timeout = None):
         logging.debug(f'{ip}: Failed to connect to port {port}, {e}')
     return s
 
-def handle(s, cmd_int):
-    cmd_bytes = cmd_int.to_bytes(4,'big')
-    s.send(cmd_bytes)
-    resp_bytes = s.recv(4)
+def recv_exact(s, n):
+    buf = b''
+    while len(buf) < n:
+        b = s.recv(n - len(buf))
+        if len(b) == 0:
+            raise ConnectionResetError('Connection closed by device')
+        buf += b
+    return buf
+
+def recv_response(s):
+    resp_bytes = recv_exact(s, 4)
     resp_int = int.from_bytes(resp_bytes, 'big')
 
     if cmd.command(resp_int) != cmd.CMD_RESPONSE:
@@ -61,29 +151,91 @@ def handle(s, cmd_int):
         return ex
 
     else:
-        resp_bytes = s.recv(4)
+        resp_bytes = recv_exact(s, 4)
         resp_int = int.from_bytes(resp_bytes, 'big')
         return resp_int
 
-def run(ip, queue_in, queue_out):
-    timeout = 0.1
-    s = connect(None, ip, cmd_port, timeout)
+def handle(s, cmd_int, rtt = None):
+    cmd_bytes = cmd_int.to_bytes(4,'big')
+    t = time.monotonic()
+    s.send(cmd_bytes)
+    resp = recv_response(s)
+    if rtt is not None: rtt.sample(time.monotonic() - t)
+    return check_response(cmd_int, resp)
+
+def handle_many(s, cmd_ints, rtt = None):
+    """ write all command words at once, then read back one response
+    (or ModuleNotPowered) per command in the order they were sent
+    """
+    cmd_bytes = b''.join([c.to_bytes(4,'big') for c in cmd_ints])
+    t = time.monotonic()
+    s.sendall(cmd_bytes)
+
+    resp = []
+    for c in cmd_ints:
+        resp.append(check_response(c, recv_response(s)))
+        if rtt is not None and len(resp) == 1:
+            rtt.sample(time.monotonic() - t)
+    return resp
+
+def run(ip, queue_in, queue_out, port = cmd_port, retries = 5):
+    """ Each item of queue_in is (command word or list of words, deadline),
+    the deadline is a time.monotonic() value or None. The per attempt
+    timeout adapts to the measured round trip time. After a timeout the
+    late reply may still arrive, so pending input is discarded before the
+    next attempt; a response that doesn't match its command (a desync)
+    drains the connection until it is quiet and the command is retried.
+    """
+    rtt = RttEstimator()
+    s = connect(None, ip, port, rtt.timeout)
+    stale = False
+
     while True:
-        cmd_int = queue_in.get()
+        item = queue_in.get()
 
-        if cmd_int is None:
+        if item is None:
             break
 
-        for _ in range(5):
+        cmd_int, deadline = item
+        response = TimeoutError(f'{ip}: command deadline expired')
+
+        for attempt in range(retries):
+            timeout = rtt.timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    response = TimeoutError(f'{ip}: command deadline expired')
+                    break
+
             try:
-                flush(s)
-                response = handle(s, cmd_int)
+                if stale:
+                    flush(s)
+                    stale = False
+                s.settimeout(timeout)
+
+                # Karn's rule, only first attempts give unambiguous samples
+                sample = rtt if attempt == 0 else None
+                if isinstance(cmd_int, list):
+                    response = handle_many(s, cmd_int, sample)
+                else:
+                    response = handle(s, cmd_int, sample)
             except TimeoutError as e:
                 response = e
+                stale = True
+                rtt.backoff()
+                metrics.retries.inc(ip = ip)
+                continue
+            except Desync as e:
+                response = e
+                logging.debug(f'{ip}: {e}, draining')
+                metrics.desyncs.inc(ip = ip)
+                drain(s, rtt.timeout, deadline)
+                stale = True
                 continue
             except Exception as e:
                 response = e
-                s = connect(s, ip, cmd_port, timeout)
+                metrics.reconnects.inc(ip = ip)
+                s = connect(s, ip, port, rtt.timeout)
             break
 
         queue_out.put(response)
@@ -91,25 +243,45 @@ def run(ip, queue_in, queue_out):
     s.close()
 
 class Gigex():
-    def __init__(self, ip):
+    def __init__(self, ip, reactor = None, ports = None):
         self.ip = ip
+        self.reactor = reactor
+
+        ports = ports or {}
+        self.cmd_port = ports.get('cmd_port', cmd_port)
+        self.info_port = ports.get('info_port', info_port)
+        self.sys_port = ports.get('sys_port', sys_port)
         self.lock = threading.Lock()
         self.queue_in = queue.Queue()
         self.queue_out = queue.Queue()
 
+        # called after a reboot or a reset command word was sent
+        self.on_reset = []
+
         self.info_stop = threading.Event()
         self.info_lock = threading.Lock()
         self.info_queue = queue.Queue()
 
     def start(self):
+        if self.reactor is not None:
+            self.cmd_channel = self.reactor.command_channel(self.ip, self.cmd_port)
+            self.info_channel = self.reactor.info_channel(
+                    self.ip, self.info_port, self.info_queue)
+            return
+
         self.thr = threading.Thread(target = run,
-                args = [self.ip, self.queue_in, self.queue_out])
+                args = [self.ip, self.queue_in, self.queue_out, self.cmd_port])
         self.thr.start()
 
         self.info_thr = threading.Thread(target = self.info)
         self.info_thr.start()
 
     def stop(self):
+        if self.reactor is not None:
+            self.reactor.call_soon(self.cmd_channel.close)
+            self.reactor.call_soon(self.info_channel.close)
+            return
+
         self.queue_in.put(None)
         self.thr.join()
 
@@ -120,30 +292,93 @@ class Gigex():
             except: pass
         self.info_thr.join()
 
-    def send(self, val):
-        with self.lock:
-            self.queue_in.put(val)
-            response = self.queue_out.get()
+    def request(self, val, deadline = None):
+        t = time.perf_counter()
+        response = self.transact(val, deadline)
+        metrics.request_seconds.observe(time.perf_counter() - t, ip = self.ip,
+                kind = 'batch' if isinstance(val, list) else 'single')
+
+        # even a failed reset may have reached the device
+        if any(cmd.is_reset(v) for v in (val if isinstance(val, list) else [val])):
+            self.reset_done()
+        return response
+
+    def reset_done(self):
+        [fun() for fun in self.on_reset]
+
+    def transact(self, val, deadline = None):
+        if self.reactor is not None:
+            expires = None if deadline is None else time.monotonic() + deadline
+            fut = self.cmd_channel.submit(val if isinstance(val, list) else [val], expires)
+            try:
+                response = fut.result(deadline)
+            except FutureTimeout:
+                # don't leave the request queued once the caller gave up
+                self.cmd_channel.abandon(fut)
+                return TimeoutError(f'{self.ip}: command deadline expired')
+            except Exception as e:
+                return e
+            return response if isinstance(val, list) else response[0]
+
+        expires = None if deadline is None else time.monotonic() + deadline
+        if not self.lock.acquire(timeout = -1 if deadline is None else deadline):
+            return TimeoutError(f'{self.ip}: command deadline expired')
+
+        try:
+            self.queue_in.put((val, expires))
+            return self.queue_out.get()
+        finally:
+            self.lock.release()
+
+    def send(self, val, deadline = None):
+        """ deadline optionally limits the seconds spent on the command,
+        retries included, before TimeoutError is raised
+        """
+        response = self.request(val, deadline)
 
         if isinstance(response, Exception):
             raise response
 
         return response
 
+    def send_many(self, vals, return_exceptions = False, deadline = None):
+        """ pipeline several command words in a single round trip
+
+        Responses are returned in the same order as vals. If
+        return_exceptions is set, per-command failures (e.g. an unpowered
+        module) are returned in place of the response, otherwise the
+        first one is raised.
+        """
+        vals = list(vals)
+        if len(vals) == 0:
+            return []
+
+        response = self.request(vals, deadline)
+
+        if isinstance(response, Exception):
+            raise response
+
+        if not return_exceptions:
+            for r in response:
+                if isinstance(r, Exception): raise r
+
+        return response
+
     def info(self):
         with self.info_lock:
-            self.info_sock = connect(None, self.ip, info_port)
+            self.info_sock = connect(None, self.ip, self.info_port)
 
         while not self.info_stop.wait(1):
             try:
                 val = self.info_sock.recv(4)
                 if len(val) == 0: break
                 val = int.from_bytes(val, 'big')
+                metrics.info_alarms.inc(ip = self.ip)
                 self.info_queue.put((self.ip, val))
             except Exception as e:
                 with self.info_lock:
                    self.info_sock = connect(self.info_sock,
-                                            self.ip, info_port)
+                                            self.ip, self.info_port)
 
     @ignore_network_errors((False,[]))
     def spi(self, *data):
@@ -154,9 +389,9 @@ class Gigex():
                 nwords_b + nwords_b + data)
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.ip, sys_port))
+        s.connect((self.ip, self.sys_port))
         s.send(cmd_bytes)
-        code,stat,_,_, *resp = self.sys.recv(1024)
+        code,stat,_,_, *resp = s.recv(1024)
         s.close()
 
         resp = [resp[i:i+4] for i in range(0, len(resp), 4)]
@@ -168,10 +403,13 @@ class Gigex():
         cmd_bytes = (0xF1000000).to_bytes(4,'big')
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.ip, sys_port))
-        s.send(cmd_bytes)
-        resp = self.sys.recv(1024)
-        s.close()
+        try:
+            s.connect((self.ip, self.sys_port))
+            s.send(cmd_bytes)
+            resp = s.recv(1024)
+        finally:
+            s.close()
+            self.reset_done()
 
         good = (resp[0] == 0xF1 and resp[1] == 0x00)
         logging.info(f'Reboot result {self.ip}: {good}')
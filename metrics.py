@@ -0,0 +1,198 @@
+import os, threading, logging, bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Process wide performance metrics in the Prometheus text format. The
+# transport and acquisition code update the metrics below unconditionally
+# (each update is a dict lookup under a lock); they are only rendered
+# when an Exporter is running, either over HTTP on a loopback port or by
+# rewriting a file for the node exporter textfile collector.
+
+def label_str(labels):
+    if len(labels) == 0: return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+class Metric():
+    def __init__(self, name, doc, kind):
+        self.name = name
+        self.doc = doc
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.add(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self):
+        with self.lock:
+            items = list(self.values.items())
+        return self.header() + [f'{self.name}{label_str(k)} {v}' for k, v in items]
+
+class Counter(Metric):
+    def __init__(self, name, doc):
+        super().__init__(name, doc, 'counter')
+
+    def inc(self, n = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+class Gauge(Metric):
+    def __init__(self, name, doc):
+        super().__init__(name, doc, 'gauge')
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    def __init__(self, name, doc, buckets):
+        super().__init__(name, doc, 'histogram')
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        with self.lock:
+            items = [(k, list(c), s) for k, (c, s) in self.values.items()]
+
+        lines = self.header()
+        for key, counts, total in items:
+            n = 0
+            for le, c in zip(self.buckets + ['+Inf'], counts):
+                n += c
+                lines.append(f'{self.name}_bucket{label_str(key + (("le", le),))} {n}')
+            lines.append(f'{self.name}_sum{label_str(key)} {total}')
+            lines.append(f'{self.name}_count{label_str(key)} {n}')
+        return lines
+
+class Registry():
+    """ metrics and collectors, collectors are called at render time to
+    update gauges from state that is cheaper to read than to track
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def collector(self, fun):
+        with self.lock:
+            self.collectors.append(fun)
+
+    def remove_collector(self, fun):
+        with self.lock:
+            if fun in self.collectors:
+                self.collectors.remove(fun)
+
+    def render(self):
+        with self.lock:
+            collectors = list(self.collectors)
+            metrics = list(self.metrics)
+
+        for fun in collectors:
+            try:
+                fun()
+            except Exception:
+                logging.debug('Metrics collector failed', exc_info = 1)
+
+        lines = []
+        for m in metrics:
+            lines += m.render()
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+rtt_buckets = [1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+request_seconds = Histogram('gigex_request_seconds',
+        'Round trip time of a command (single) or pipelined batch', rtt_buckets)
+retries = Counter('gigex_retries_total', 'Command retries after a timeout')
+reconnects = Counter('gigex_reconnects_total', 'Command port reconnects after an error')
+desyncs = Counter('gigex_desyncs_total', 'Responses that did not match their command')
+info_alarms = Counter('gigex_info_alarms_total', 'Words received on the info port')
+
+acq_received = Gauge('acq_received_bytes', 'Bytes received in the current acquisition')
+acq_delivered = Gauge('acq_delivered_bytes', 'Bytes delivered to a sink in the current acquisition')
+acq_dropped = Gauge('acq_dropped_bytes', 'Bytes dropped by a sink in the current acquisition')
+acq_blocked = Gauge('acq_blocked_seconds', 'Seconds spent blocked writing to a sink')
+acq_throughput = Gauge('acq_throughput_bytes_per_second', 'Receive rate since the last scrape')
+queue_depth = Gauge('queue_depth', 'Items waiting in an internal queue')
+
+sweep_seconds = Histogram('monitor_sweep_seconds', 'Duration of a backend monitor sweep',
+        [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0])
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Exporter():
+    """ Serve the registry over HTTP on host:port, and/or rewrite path
+    every interval seconds (atomically, via a temporary file)
+    """
+
+    def __init__(self, port = None, path = None, interval = 10.0, host = '127.0.0.1'):
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.host = host
+        self.server = None
+        self.stop_ev = threading.Event()
+        self.threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *context):
+        self.stop()
+
+    def start(self):
+        if self.port is not None:
+            self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+            self.threads.append(threading.Thread(target = self.server.serve_forever))
+            logging.info(f'Serving metrics on http://{self.host}:{self.server.server_port}/metrics')
+
+        if self.path is not None:
+            self.threads.append(threading.Thread(target = self.write_file))
+
+        [thr.start() for thr in self.threads]
+
+    def stop(self):
+        self.stop_ev.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        [thr.join() for thr in self.threads]
+        self.threads = []
+
+    def write_file(self):
+        while True:
+            tmp = self.path + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    f.write(registry.render())
+                os.replace(tmp, self.path)
+            except OSError:
+                logging.exception(f'Failed to write metrics to {self.path}')
+
+            if self.stop_ev.wait(self.interval):
+                return
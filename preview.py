@@ -0,0 +1,112 @@
+import time, queue, threading, collections
+import numpy as np
+import sgl
+
+# Live preview of a backend data stream. The receive thread only hands a
+# slice of some chunks to a worker, which summarizes them with numpy; the
+# UI polls the latest summary at its own frame rate.
+
+Summary = collections.namedtuple('Summary',
+        ['time', 'bytes_per_s', 'module_rates', 'command_fraction', 'histogram'])
+
+class Preview():
+    """ acquire() sink that computes decimated stream statistics
+
+    At most sample_bytes of a chunk are queued for the worker, and chunks
+    are skipped while it is busy. Every interval seconds the worker
+    publishes a Summary: the total byte rate, the word rate of each module
+    (the total rate split by the sampled module fractions), the fraction
+    of command words and a histogram of the data word payloads that decays
+    by decay per interval.
+
+    The preview outlives each acquisition, so close() does nothing;
+    start() and stop() run the worker.
+    """
+
+    # a Tee may drop chunks for the preview rather than wait for it
+    lossy = True
+
+    def __init__(self, nmodules = 4, interval = 0.5, sample_bytes = 16384,
+                 nbins = 32, decay = 0.8):
+        self.nmodules = nmodules
+        self.interval = interval
+        self.sample_bytes = sample_bytes - (sample_bytes % 4)
+        self.nbins = nbins
+        self.decay = decay
+
+        self.chunks = queue.Queue(maxsize = 4)
+        self.exit = threading.Event()
+        self.received = 0
+        self.summary = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        pass
+
+    def __repr__(self):
+        return 'Preview()'
+
+    def start(self):
+        self.thr = threading.Thread(target = self.run)
+        self.thr.start()
+
+    def stop(self):
+        self.exit.set()
+        self.thr.join()
+
+    def write(self, data):
+        # chunks start anywhere in the stream, skip to the next word
+        head = -self.received % 4
+        self.received += len(data)
+        if len(data) >= head + 4 and not self.chunks.full():
+            try:
+                self.chunks.put_nowait(bytes(data[head:head + self.sample_bytes]))
+            except queue.Full: pass
+
+    def close(self):
+        pass
+
+    def run(self):
+        hist = np.zeros(self.nbins)
+        counts = np.zeros(self.nmodules)
+        ncmd = nwords = 0
+        last_received = self.received
+        last = time.monotonic()
+        shift = 20 - int(np.log2(self.nbins))
+
+        while not self.exit.is_set():
+            try:
+                d = self.chunks.get(timeout = self.interval)
+                words = np.frombuffer(d, dtype = '>u4', count = len(d) // 4).astype(np.uint32)
+                cmd_mask = sgl.is_command(words)
+                data = words[~cmd_mask]
+                mod = sgl.module(data)
+
+                counts += np.bincount(mod, minlength = 16)[:self.nmodules]
+                hist += np.bincount(sgl.payload(data) >> shift, minlength = self.nbins)
+                ncmd += int(cmd_mask.sum())
+                nwords += len(words)
+            except queue.Empty: pass
+
+            now = time.monotonic()
+            if now - last < self.interval: continue
+
+            rate = (self.received - last_received) / (now - last)
+            word_rate = rate / 4
+            total = max(nwords, 1)
+
+            self.summary = Summary(now, rate,
+                    (word_rate * counts / total).tolist(),
+                    ncmd / total, hist.tolist())
+
+            hist *= self.decay
+            counts[:] = 0
+            ncmd = nwords = 0
+            last_received = self.received
+            last = now
+
+    def latest(self):
+        """ the most recent Summary, or None before the first interval """
+        return self.summary
@@ -0,0 +1,487 @@
+import selectors, socket, threading, queue, heapq, itertools, collections
+import errno, os, time, logging
+from concurrent.futures import Future
+import command as cmd
+from gigex import ModuleNotPowered, Backoff, RttEstimator, Desync, check_response
+import metrics
+
+# A single event loop that owns every cmd_port, info_port and data_port
+# socket. The blocking Gigex / acquire API is layered on top with futures
+# and queues, so only the loop thread ever touches a socket.
+
+class Reactor():
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        self.timers = []
+        self.seq = itertools.count()
+        self.calls = queue.SimpleQueue()
+        self.stop_ev = threading.Event()
+        self.thr = None
+
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.sel.register(self.wake_r, selectors.EVENT_READ, self.on_wake)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *context):
+        self.stop()
+
+    def start(self):
+        self.stop_ev.clear()
+        self.thr = threading.Thread(target = self.run)
+        self.thr.start()
+
+    def stop(self):
+        self.stop_ev.set()
+        self.wake()
+        self.thr.join()
+
+    def wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except (BlockingIOError, OSError): pass
+
+    def on_wake(self, mask):
+        try:
+            while self.wake_r.recv(1024): pass
+        except BlockingIOError: pass
+
+    def call_soon(self, fun, *args):
+        """ thread safe, fun runs on the loop thread """
+        self.calls.put((fun, args))
+        self.wake()
+
+    def call_later(self, delay, fun, *args):
+        """ loop thread only, returns a handle that can be cancelled """
+        timer = [time.monotonic() + delay, next(self.seq), fun, args, True]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        if timer is not None:
+            timer[4] = False
+
+    def dispatch(self, fun, *args):
+        try:
+            fun(*args)
+        except Exception:
+            logging.warning('Reactor callback failed', exc_info = 1)
+
+    def run(self):
+        while not self.stop_ev.is_set():
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.monotonic())
+
+            for key, mask in self.sel.select(timeout):
+                self.dispatch(key.data, mask)
+
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, fun, args, active = heapq.heappop(self.timers)
+                if active: self.dispatch(fun, *args)
+
+            while True:
+                try:
+                    fun, args = self.calls.get_nowait()
+                except queue.Empty:
+                    break
+                self.dispatch(fun, *args)
+
+        for key in list(self.sel.get_map().values()):
+            if isinstance(key.data.__self__, Connection):
+                key.data.__self__.close()
+
+    # Factories for the blocking wrappers
+
+    def command_channel(self, ip, port, timeout = 0.1):
+        return CommandChannel(self, ip, port, timeout)
+
+    def info_channel(self, ip, port, out_queue):
+        conn = InfoChannel(self, ip, port, out_queue)
+        self.call_soon(conn.open)
+        return conn
+
+    def data_stream(self, ip, port, stop, timeout = 0.1, gaps = None):
+        return DataStream(self, ip, port, stop, timeout, gaps = gaps)
+
+class Connection():
+    def __init__(self, reactor, ip, port, timeout = 0.1):
+        self.reactor = reactor
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.s = None
+        self.connected = False
+        self.closed = False
+        self.tx = bytearray()
+
+    def open(self):
+        if self.closed or self.s is not None:
+            return
+
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setblocking(False)
+        err = self.s.connect_ex((self.ip, self.port))
+        if err not in (0, errno.EINPROGRESS):
+            self.on_error(OSError(err, os.strerror(err)))
+            return
+
+        self.reactor.sel.register(self.s, selectors.EVENT_WRITE, self.on_connect)
+
+    def on_connect(self, mask):
+        err = self.s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.on_error(OSError(err, os.strerror(err)))
+            return
+
+        logging.debug(f'{self.ip}: reactor connected to port {self.port}')
+        self.connected = True
+        self.update()
+        self.on_connected()
+
+    def update(self):
+        if self.s is None: return
+        mask = selectors.EVENT_READ
+        if self.tx: mask |= selectors.EVENT_WRITE
+        self.reactor.sel.modify(self.s, mask, self.on_event)
+
+    def write(self, data):
+        self.tx += data
+        self.flush_tx()
+
+    def flush_tx(self):
+        try:
+            sent = self.s.send(self.tx)
+            del self.tx[:sent]
+        except BlockingIOError: pass
+        self.update()
+
+    def on_event(self, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.flush_tx()
+            if mask & selectors.EVENT_READ:
+                data = self.s.recv(self.recv_size)
+                if len(data) == 0:
+                    raise ConnectionResetError('Connection closed by device')
+                self.on_data(data)
+        except BlockingIOError: pass
+        except OSError as e:
+            self.on_error(e)
+
+    def drop(self):
+        if self.s is not None:
+            try:
+                self.reactor.sel.unregister(self.s)
+            except (KeyError, ValueError): pass
+            self.s.close()
+        self.s = None
+        self.connected = False
+        self.tx.clear()
+
+    def close(self):
+        self.closed = True
+        self.drop()
+
+    recv_size = 1024
+    def on_connected(self): pass
+    def on_data(self, data): pass
+    def on_error(self, e):
+        logging.debug(f'{self.ip}: port {self.port} error, {e}')
+        self.drop()
+
+class CommandChannel(Connection):
+    """ Equivalent of gigex.run: one request in flight, each one retried up
+    to five times on timeout, reconnecting after any other error. The
+    attempt timeout adapts to the round trip time; after a timeout a late
+    reply may still arrive, so pending input is discarded before the next
+    transmit, and a response that doesn't match its command drains the
+    connection until it is quiet before the retry.
+    """
+
+    retries = 5
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.rtt = RttEstimator(initial = self.timeout)
+        self.requests = collections.deque()
+        self.current = None
+        self.attempt = 0
+        self.responses = []
+        self.rx = bytearray()
+        self.timer = None
+        self.sent = None
+        self.stale = False
+        self.draining = False
+
+    def submit(self, words, deadline = None):
+        """ thread safe, resolves to a list with one response (or
+        ModuleNotPowered) per command word. deadline is a time.monotonic()
+        value after which the request is given up.
+        """
+        fut = Future()
+        self.reactor.call_soon(self.enqueue, list(words), fut, deadline)
+        return fut
+
+    def abandon(self, fut):
+        """ thread safe, give up a request whose caller stopped waiting """
+        fut.cancel()
+        self.reactor.call_soon(self.on_abandon, fut)
+
+    def on_abandon(self, fut):
+        if self.current is not None and self.current[1] is fut:
+            self.stale = True
+            self.finish(TimeoutError(f'{self.ip}: command deadline expired'))
+
+    def enqueue(self, words, fut, deadline):
+        if self.closed:
+            fut.set_exception(ConnectionAbortedError('Channel closed'))
+            return
+        self.requests.append((words, fut, deadline))
+        self.next()
+
+    def next(self):
+        if self.current is not None:
+            return
+
+        # requests given up while queued are never sent
+        while self.requests and self.requests[0][1].cancelled():
+            self.requests.popleft()
+        if len(self.requests) == 0:
+            return
+
+        if not self.connected:
+            self.open()
+            return
+
+        self.current = self.requests.popleft()
+        self.attempt = 0
+        self.transmit()
+
+    def on_connected(self):
+        self.next()
+
+    def attempt_timeout(self):
+        _, _, deadline = self.current
+        timeout = self.rtt.timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        return timeout
+
+    def transmit(self):
+        timeout = self.attempt_timeout()
+        if timeout <= 0:
+            self.finish(TimeoutError(f'{self.ip}: command deadline expired'))
+            return
+
+        if self.stale and not self.discard():
+            return
+
+        words, _, _ = self.current
+        self.rx.clear()
+        self.responses = []
+        self.draining = False
+        # Karn's rule, only first attempts give unambiguous samples
+        self.sent = time.monotonic() if self.attempt == 0 else None
+        self.write(b''.join([w.to_bytes(4,'big') for w in words]))
+        self.timer = self.reactor.call_later(timeout, self.on_timeout)
+
+    def discard(self):
+        """ drop input that arrived for an earlier attempt or request,
+        False if the connection failed meanwhile
+        """
+        self.rx.clear()
+        self.stale = False
+        try:
+            while len(self.s.recv(self.recv_size)) > 0: pass
+        except BlockingIOError: pass
+        except OSError as e:
+            self.on_error(e)
+            return False
+        return True
+
+    def retry(self, error):
+        self.timer = None
+        self.attempt += 1
+        if self.attempt < self.retries:
+            self.transmit()
+        else:
+            self.finish(error)
+
+    def on_timeout(self):
+        if self.draining:
+            # quiet again after a desync
+            self.retry(Desync(f'{self.ip}: responses out of sync'))
+            return
+
+        self.stale = True
+        self.rtt.backoff()
+        metrics.retries.inc(ip = self.ip)
+        self.retry(TimeoutError(f'{self.ip}: command timed out'))
+
+    def finish(self, result):
+        self.reactor.cancel(self.timer)
+        self.timer = None
+        self.draining = False
+        _, fut, _ = self.current
+        self.current = None
+
+        if fut.cancelled():
+            pass
+        elif isinstance(result, Exception):
+            fut.set_exception(result)
+        else:
+            fut.set_result(result)
+
+        self.next()
+
+    def on_data(self, data):
+        if self.current is None:
+            # a late reply to a request that already failed
+            self.stale = True
+            return
+
+        if self.draining:
+            # wait for the connection to be quiet for a whole timeout
+            self.reactor.cancel(self.timer)
+            self.timer = self.reactor.call_later(self.rtt.timeout, self.on_timeout)
+            return
+
+        self.rx += data
+        words, _, _ = self.current
+        while len(self.responses) < len(words):
+            if len(self.rx) < 4: return
+            resp = int.from_bytes(self.rx[0:4], 'big')
+            nbytes = 4
+
+            if cmd.command(resp) == cmd.CMD_RESPONSE:
+                if cmd.payload(resp) == 0:
+                    chn = cmd.module(resp)
+                    resp = ModuleNotPowered(f'Channel {chn} is not powered')
+                else:
+                    if len(self.rx) < 8: return
+                    resp = int.from_bytes(self.rx[4:8], 'big')
+                    nbytes = 8
+
+            del self.rx[:nbytes]
+            try:
+                resp = check_response(words[len(self.responses)], resp)
+            except Desync as e:
+                logging.debug(f'{self.ip}: {e}, draining')
+                metrics.desyncs.inc(ip = self.ip)
+                self.rx.clear()
+                self.draining = True
+                self.reactor.cancel(self.timer)
+                self.timer = self.reactor.call_later(self.rtt.timeout, self.on_timeout)
+                return
+
+            if len(self.responses) == 0 and self.sent is not None:
+                self.rtt.sample(time.monotonic() - self.sent)
+            self.responses.append(resp)
+
+        self.finish(self.responses)
+
+    def on_error(self, e):
+        super().on_error(e)
+        metrics.reconnects.inc(ip = self.ip)
+        self.stale = False
+        if self.current is not None:
+            self.finish(e)
+        else:
+            while self.requests:
+                _, fut, _ = self.requests.popleft()
+                if not fut.cancelled(): fut.set_exception(e)
+
+    def close(self):
+        super().close()
+        if self.current is not None:
+            self.finish(ConnectionAbortedError('Channel closed'))
+        while self.requests:
+            _, fut, _ = self.requests.popleft()
+            if not fut.cancelled(): fut.set_exception(ConnectionAbortedError('Channel closed'))
+
+class InfoChannel(Connection):
+    def __init__(self, reactor, ip, port, out_queue):
+        super().__init__(reactor, ip, port)
+        self.out_queue = out_queue
+        self.rx = bytearray()
+
+    def on_data(self, data):
+        self.rx += data
+        while len(self.rx) >= 4:
+            val = int.from_bytes(self.rx[0:4], 'big')
+            del self.rx[:4]
+            metrics.info_alarms.inc(ip = self.ip)
+            self.out_queue.put((self.ip, val))
+
+    def on_error(self, e):
+        super().on_error(e)
+        self.rx.clear()
+        if not self.closed:
+            self.reactor.call_later(1.0, self.open)
+
+class DataStream(Connection):
+    """ Drop-in replacement for backend.BackendAcq, the socket is read by
+    the loop thread and chunks are handed over through a bounded queue.
+    Reading pauses while the queue is full, which pushes back on the
+    backend exactly like a slow blocking reader would.
+    """
+
+    recv_size = 8192
+
+    def __init__(self, reactor, ip, port, stop, timeout = 0.1, depth = 64, gaps = None):
+        super().__init__(reactor, ip, port, timeout)
+        self.stop = stop
+        self.chunks = queue.Queue(maxsize = depth)
+        self.paused = False
+        # optional backend.Gaps, told when the stream is lost and resumes
+        self.gaps = gaps
+        self.backoff = Backoff()
+
+    def __iter__(self):
+        self.reactor.call_soon(self.open)
+        try:
+            while not self.stop.is_set():
+                try:
+                    chunk = self.chunks.get(timeout = self.timeout)
+                except queue.Empty:
+                    yield b''
+                    continue
+                # there is room again, reading restarts on the loop thread
+                if self.paused: self.reactor.call_soon(self.resume)
+                yield chunk
+        finally:
+            self.reactor.call_soon(self.close)
+
+    def on_data(self, data):
+        if self.gaps is not None: self.gaps.resumed()
+        self.backoff.reset()
+        self.chunks.put_nowait(data)
+        if self.chunks.full():
+            self.reactor.sel.unregister(self.s)
+            self.paused = True
+            # the consumer may have taken a chunk before it could see paused
+            if not self.chunks.full(): self.resume()
+
+    def resume(self):
+        if self.s is None or not self.paused or self.chunks.full():
+            return
+
+        self.paused = False
+        self.reactor.sel.register(self.s, selectors.EVENT_READ, self.on_event)
+
+    def drop(self):
+        self.paused = False
+        super().drop()
+
+    def on_error(self, e):
+        super().on_error(e)
+        if self.gaps is not None: self.gaps.lost(e)
+        if not self.closed:
+            self.reactor.call_later(self.backoff.next(), self.open)
@@ -0,0 +1,176 @@
+import os, time, threading, logging, hashlib, tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
+import metrics
+
+# Background relocation of finished acquisition files. Stopping an
+# acquisition only renames its files into a staging directory next to
+# them (a rename on the same device, so instant), which frees the names
+# for the next acquisition. A worker pool then moves the staged files to
+# their destination: again a rename when it is on the same device,
+# otherwise a copy that hashes the data as it streams through and leaves
+# a sha256sum compatible <file>.sha256 beside the copy.
+
+pending_bytes = metrics.Gauge('relocate_pending_bytes',
+        'Bytes of finished acquisitions still to be moved to their destination')
+
+def same_device(path, dest_dir):
+    return os.stat(path).st_dev == os.stat(dest_dir).st_dev
+
+class Relocation():
+    """ one batch of files moved to dest, progress() is (done, total) bytes """
+
+    def __init__(self, files, dest, on_progress = None):
+        self.files = files
+        self.dest = dest
+        self.on_progress = on_progress
+        self.lock = threading.Lock()
+        self.total = sum(os.path.getsize(f) for f in files)
+        self.done = 0
+        self.errors = []
+        self.futures = []
+        self.started = time.monotonic()
+
+    def __repr__(self):
+        return f'Relocation({self.dest}, {len(self.files)} files)'
+
+    def add(self, nbytes):
+        with self.lock:
+            self.done += nbytes
+            done, total = self.done, self.total
+        if self.on_progress is not None:
+            self.on_progress(done, total)
+
+    def progress(self):
+        with self.lock:
+            return self.done, self.total
+
+    def finished(self):
+        return all(f.done() for f in self.futures)
+
+    def wait(self, timeout = None):
+        """ True once every file has been moved (or has failed) """
+        return len(wait(self.futures, timeout).not_done) == 0
+
+class Relocator():
+    """ Moves batches of files to a destination directory on a pool of
+    worker threads, one file per task
+
+    relocate() returns immediately with a Relocation. progress(done,
+    total) is called with the bytes of a batch moved so far, copies
+    report every chunk_size bytes.
+    """
+
+    def __init__(self, workers = 4, chunk_size = 8 << 20, progress = None):
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.batches = []
+        metrics.registry.collector(self.collect_metrics)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def close(self):
+        # pending moves are finished, not abandoned
+        self.executor.shutdown(wait = True)
+        metrics.registry.remove_collector(self.collect_metrics)
+
+    @property
+    def pending(self):
+        self.batches = [b for b in self.batches if not b.finished()]
+        return self.batches
+
+    def backlog(self):
+        """ (done, total) bytes of every batch still being moved """
+        progress = [b.progress() for b in self.pending]
+        return sum(d for d, _ in progress), sum(t for _, t in progress)
+
+    def collect_metrics(self):
+        done, total = self.backlog()
+        pending_bytes.set(total - done)
+
+    def stage(self, files):
+        """ rename files into a new batch directory under .staging beside
+        them, files that can't be staged are left where they are
+        """
+        prefix = time.strftime('%Y%m%d-%H%M%S-')
+        batches = {}
+        staged = []
+        for f in files:
+            try:
+                parent = os.path.join(os.path.dirname(os.path.abspath(f)), '.staging')
+                if parent not in batches:
+                    os.makedirs(parent, exist_ok = True)
+                    batches[parent] = tempfile.mkdtemp(prefix = prefix, dir = parent)
+                path = os.path.join(batches[parent], os.path.basename(f))
+                os.rename(f, path)
+                staged.append(path)
+            except OSError:
+                logging.exception(f'Failed to stage {f}')
+        return staged
+
+    def relocate(self, files, dest):
+        """ stage files and move them to the dest directory in the
+        background
+        """
+        staged = self.stage(files)
+
+        os.makedirs(dest, exist_ok = True)
+        job = Relocation(staged, dest, self.progress)
+        job.futures = [self.executor.submit(self.move, f, job) for f in staged]
+        self.batches.append(job)
+        threading.Thread(target = self.report, args = [job], daemon = True).start()
+        return job
+
+    def move(self, path, job):
+        target = os.path.join(job.dest, os.path.basename(path))
+        try:
+            if same_device(path, job.dest):
+                size = os.path.getsize(path)
+                os.rename(path, target)
+                job.add(size)
+            else:
+                self.copy(path, target, job)
+                os.remove(path)
+        except Exception as e:
+            with job.lock:
+                job.errors.append((path, e))
+            logging.exception(f'Failed to move {path} to {job.dest}, it is left in place')
+            raise
+
+        try:
+            # the batch directory goes once it is empty
+            os.rmdir(os.path.dirname(path))
+        except OSError: pass
+
+    def copy(self, path, target, job):
+        digest = hashlib.sha256()
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        part = target + '.part'
+
+        with open(path, 'rb', buffering = 0) as src, open(part, 'wb') as dst:
+            while True:
+                n = src.readinto(buf)
+                if n == 0: break
+                digest.update(view[:n])
+                dst.write(view[:n])
+                job.add(n)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        os.replace(part, target)
+        with open(target + '.sha256', 'w') as f:
+            f.write(f'{digest.hexdigest()}  {os.path.basename(target)}\n')
+
+    def report(self, job):
+        job.wait()
+        elapsed = time.monotonic() - job.started
+        done, total = job.progress()
+        if job.errors:
+            logging.error(f'{job}: {len(job.errors)} files failed, {done} of {total} bytes moved')
+        else:
+            logging.info(f'{job}: {total} bytes moved in {elapsed:.1f} s')
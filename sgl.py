@@ -0,0 +1,280 @@
+import os, json, time, struct, collections
+import numpy as np
+from datetime import datetime
+from sinks import FileWriter, FrameReader, compressed_path
+
+# Container format for singles files
+#
+# <name>.SGL   header block, then the raw word stream exactly as received
+# <name>.SGL.tidx   time index, one fixed size record per index period
+#
+# The header block is header_size bytes (a multiple of 4096): the magic,
+# header_size and the length of a JSON document with the backend IP, start
+# time and a configuration snapshot. Record k of the time index holds the
+# host monotonic time and the data offset of the first chunk received at or
+# after start + k * period, so any time is found with one seek.
+#
+# Written through a sinks.CompressedWriter, the header and data are in
+# <name>.SGL.<codec> instead, framed as listed in <name>.SGL.<codec>.idx;
+# the readers below then decompress only the frames a range covers.
+
+container_magic = b'SGLC0001'
+header_prefix = struct.Struct('>8sII')
+header_align = 4096
+
+tidx_magic = b'SGLTIDX1'
+tidx_header = struct.Struct('>8sdd')
+tidx_record = struct.Struct('>dQ')
+
+def build_header(meta):
+    doc = json.dumps(meta).encode('utf-8')
+    size = header_prefix.size + len(doc)
+    size = ((size + header_align - 1) // header_align) * header_align
+    header = header_prefix.pack(container_magic, size, len(doc)) + doc
+    return header.ljust(size, b'\0')
+
+def read_header(f):
+    """ returns (header_size, metadata), or (0, None) for a bare SGL file """
+    f.seek(0)
+    prefix = f.read(header_prefix.size)
+    if len(prefix) < header_prefix.size or prefix[:8] != container_magic:
+        return 0, None
+    _, size, doc_len = header_prefix.unpack(prefix)
+    return size, json.loads(f.read(doc_len))
+
+class ContainerWriter():
+    """ Sink that writes the container header and time index around the
+    raw stream. The data itself goes through writer (a FileWriter by
+    default), so disk I/O stays off the receive thread.
+    """
+
+    def __init__(self, path, meta = None, period = 1.0, writer = FileWriter):
+        self.path = path
+        self.period = period
+        self.t0 = time.monotonic()
+
+        meta = dict(meta or {})
+        meta.update({'start_time': datetime.now().isoformat(),
+                     'start_epoch': time.time(),
+                     'start_monotonic': self.t0,
+                     'index_period': period})
+
+        self.header = build_header(meta)
+        self.out = writer(path)
+        self.out.write(self.header)
+
+        self.tidx = open(path + '.tidx', 'wb')
+        self.tidx.write(tidx_header.pack(tidx_magic, self.t0, period))
+        self.next_slot = 0
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'ContainerWriter({self.path})'
+
+    def index_to(self, now):
+        slot = int((now - self.t0) / self.period)
+        while self.next_slot <= slot:
+            self.tidx.write(tidx_record.pack(now, self.offset))
+            self.next_slot += 1
+
+    def write(self, data):
+        if len(data) == 0: return
+        self.index_to(time.monotonic())
+        self.out.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        if self.tidx.closed: return
+        # terminating record, so the last slot has an end offset
+        now = time.monotonic()
+        self.index_to(now)
+        self.tidx.write(tidx_record.pack(now, self.offset))
+        self.tidx.close()
+        self.out.close()
+
+class ContainerReader():
+    """ Time range access to a container file, each lookup reads a
+    single index record
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open_stream(path)
+        self.header_size, self.meta = read_header(self.f)
+        if self.meta is None:
+            raise ValueError(f'{path} has no container header')
+
+        self.tidx = open(path + '.tidx', 'rb')
+        magic, self.t0, self.period = tidx_header.unpack(self.tidx.read(tidx_header.size))
+        if magic != tidx_magic:
+            raise ValueError(f'{path}.tidx is not a time index')
+
+        nbytes = os.fstat(self.tidx.fileno()).st_size - tidx_header.size
+        self.nrecords = nbytes // tidx_record.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def close(self):
+        self.f.close()
+        self.tidx.close()
+
+    @property
+    def duration(self):
+        return (self.nrecords - 1) * self.period
+
+    def record(self, k):
+        k = min(max(k, 0), self.nrecords - 1)
+        self.tidx.seek(tidx_header.size + k * tidx_record.size)
+        return tidx_record.unpack(self.tidx.read(tidx_record.size))
+
+    def offset_at(self, t):
+        """ data offset (word aligned) of the first chunk received at or
+        after t seconds from the start of the run
+        """
+        _, offset = self.record(int(t / self.period))
+        return offset - (offset % 4)
+
+    def byte_range(self, t_start, t_stop):
+        """ (file offset, length) of the data received in [t_start, t_stop) """
+        start = self.offset_at(t_start)
+        stop = self.offset_at(t_stop) if t_stop < self.duration else self.record(self.nrecords)[1]
+        stop -= stop % 4
+        return self.header_size + start, max(0, stop - start)
+
+    def read(self, t_start, t_stop):
+        offset, length = self.byte_range(t_start, t_stop)
+        self.f.seek(offset)
+        return self.f.read(length)
+
+# Vectorized decoding, using the same field layout as command.py
+
+def is_command(words):
+    return (words >> 28) == 0xF
+
+def module(words):
+    return (words >> 24) & 0xF
+
+def command(words):
+    return (words >> 20) & 0xF
+
+def payload(words):
+    return words & 0xFFFFF
+
+def open_stream(path):
+    """ the raw stream of an SGL file, from the compressed file written
+    for path if there is no plain one
+    """
+    compressed = None if os.path.exists(path) else compressed_path(path)
+    if compressed is not None:
+        return FrameReader(compressed)
+    return open(path, 'rb')
+
+def time_range(path, t_start, t_stop):
+    """ (first word, end word) of the data received in [t_start, t_stop)
+    seconds from the start of a container run
+    """
+    with ContainerReader(path) as rd:
+        offset, length = rd.byte_range(t_start or 0, t_stop or float('inf'))
+        start = (offset - rd.header_size) // 4
+        return start, start + length // 4
+
+def open_words(path):
+    """ memory map a bare or container SGL file as big-endian uint32
+    words, returns the map and the container metadata (or None)
+    """
+    with open(path, 'rb') as f:
+        header_size, meta = read_header(f)
+
+    nwords = (os.path.getsize(path) - header_size) // 4
+    if nwords == 0:
+        return np.zeros(0, dtype = '>u4'), meta
+
+    words = np.memmap(path, dtype = '>u4', mode = 'r',
+                      offset = header_size, shape = (nwords,))
+    return words, meta
+
+# Singles timing used by the in-process coincidence sorter. Detector data
+# words carry their module in bits 24:27 and a fine time stamp in the
+# payload bits 0:19. Data words with TIMETAG in bits 28:31 are time tags,
+# each one advances the coarse clock by one period of 2**fine_bits ticks.
+# Only this function needs to change if the firmware layout does.
+
+TIMETAG = 0xE
+fine_bits = 20
+
+def event_times(words, coarse = 0):
+    """ returns (times, single words, coarse clock after the block) for
+    a block of native uint32 words, times in fine clock ticks
+    """
+    top = words >> 28
+    tt = top == TIMETAG
+    single = (top != TIMETAG) & (top != 0xF)
+
+    clock = coarse + np.cumsum(tt, dtype = np.uint64)
+    times = (clock[single] << np.uint64(fine_bits)) | payload(words[single]).astype(np.uint64)
+    return times, words[single], coarse + int(tt.sum())
+
+Chunk = collections.namedtuple('Chunk', ['offset', 'commands', 'modules'])
+
+def split_chunk(words, offset = 0, nmodules = 4):
+    """ split a block of words into command/response words and the
+    detector data of each module. The module arrays are views into one
+    array sorted (stably) by module, so the order within each is kept.
+    """
+    words = words.astype(np.uint32)
+    cmd_mask = is_command(words)
+    data = words[~cmd_mask]
+
+    mod = module(data)
+    keep = mod < nmodules
+    data, mod = data[keep], mod[keep]
+
+    order = np.argsort(mod, kind = 'stable')
+    data = data[order]
+    bounds = np.searchsorted(mod[order], np.arange(1, nmodules))
+    per_module = np.split(data, bounds)
+    return Chunk(offset, words[cmd_mask], dict(enumerate(per_module)))
+
+def iter_chunks(path, chunk_words = 1 << 22, t_start = None, t_stop = None, nmodules = 4):
+    """ iterate over an SGL file chunk_words at a time without reading
+    the whole file into memory. For container files t_start and t_stop
+    (seconds from the start of the run) restrict the range using the
+    time index. A file written through a sinks.CompressedWriter is read
+    a frame at a time.
+    """
+    if not os.path.exists(path) and compressed_path(path) is not None:
+        yield from iter_frames(path, chunk_words, t_start, t_stop, nmodules)
+        return
+
+    words, meta = open_words(path)
+    start, stop = 0, len(words)
+
+    if t_start is not None or t_stop is not None:
+        start, stop = time_range(path, t_start, t_stop)
+
+    for i in range(start, stop, chunk_words):
+        block = words[i:min(i + chunk_words, stop)]
+        yield split_chunk(block, i * 4, nmodules)
+
+def iter_frames(path, chunk_words, t_start, t_stop, nmodules):
+    with open_stream(path) as f:
+        header_size, _ = read_header(f)
+        start, stop = 0, (f.size - header_size) // 4
+
+        if t_start is not None or t_stop is not None:
+            start, stop = time_range(path, t_start, t_stop)
+
+        for i in range(start, stop, chunk_words):
+            f.seek(header_size + 4 * i)
+            block = np.frombuffer(f.read(4 * min(chunk_words, stop - i)), dtype = '>u4')
+            yield split_chunk(block, i * 4, nmodules)
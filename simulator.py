@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+import socket, threading, logging, time, math, random, argparse
+import command as cmd
+import sgl
+from gigex import cmd_port, info_port, sys_port
+from backend import data_port
+
+# Stand-ins for the sync and backend boards on loopback addresses, so the
+# whole system can be driven without the 192.168.1.10x hardware:
+#   System(sync_ip = sim_sync_ip, backend_ips = sim_backend_ips)
+
+sim_sync_ip = '127.0.0.100'
+sim_backend_ips = ['127.0.0.101', '127.0.0.102', '127.0.0.103', '127.0.0.104']
+
+frontend_cmds = [cmd.DAC_WRITE, cmd.ADC_READ, cmd.MODULE_ID, cmd.DAC_READ,
+                 cmd.PERIOD_READ, cmd.SGL_RATE_READ, cmd.GPIO_FRONEND]
+
+def temp_to_adc(temp, Vin = 2.5, Rs = 10000, R0 = 10000, T0 = 298.15, B = 3900):
+    """ inverse of frontend.adc_to_temp """
+    R = R0 * math.exp(B * (1.0 / (temp + 273.15) - 1.0 / T0))
+    V = Vin * R / (Rs + R)
+    return round(V / 2.048 * 0x7FF) & 0xFFF
+
+def synthetic_data(nbytes, seed = 0, period_words = 1024):
+    """ big-endian words laid out as sgl.event_times expects: a time tag
+    every period_words words, detector data with increasing fine times in
+    between, and some command words
+    """
+    rng = random.Random(seed)
+    step = 2 * (1 << sgl.fine_bits) // period_words
+    words = []
+    fine = 0
+    for i in range(nbytes // 4):
+        m = rng.randrange(4)
+        if i % period_words == 0:
+            w = sgl.TIMETAG << 28
+            fine = 0
+        elif rng.random() < 0.05:
+            w = cmd.build(m, cmd.SGL_RATE_READ, rng.getrandbits(20))
+        else:
+            fine = min(fine + rng.randrange(step), 0xFFFFF)
+            w = (rng.randrange(sgl.TIMETAG) << 28) | (m << 24) | (rng.getrandbits(4) << 20) | fine
+        words.append(w.to_bytes(4, 'big'))
+    return b''.join(words)
+
+def recv_exact(c, n):
+    buf = b''
+    while len(buf) < n:
+        b = c.recv(n - len(buf))
+        if len(b) == 0: raise ConnectionResetError
+        buf += b
+    return buf
+
+class SimDevice():
+    """ Serves the command, info, data and sys ports of one board
+
+    data_rate is in bytes per second, None streams as fast as possible.
+    latency adds a delay before each command response and relay_header
+    prefixes frontend responses with a CMD_RESPONSE word, as the backend
+    does when it forwards a reply from a frontend.
+    """
+
+    def __init__(self, ip, is_sync = False, index = 0, data_rate = 1e6,
+                 latency = 0.0, relay_header = False, ports = None):
+        ports = ports or {}
+        self.ip = ip
+        self.is_sync = is_sync
+        self.ports = {'cmd':  ports.get('cmd_port', cmd_port),
+                      'info': ports.get('info_port', info_port),
+                      'data': ports.get('data_port', data_port),
+                      'sys':  ports.get('sys_port', sys_port)}
+
+        self.data_rate = data_rate
+        self.latency = latency
+        self.relay_header = relay_header
+
+        self.lock = threading.Lock()
+        self.stop_ev = threading.Event()
+        self.servers = []
+        self.threads = []
+        self.info_clients = []
+
+        self.bank0 = 0
+        self.reg = 0
+        self.dac = [[0]*16 for _ in range(4)]
+        self.temps = [[25.0]*8 for _ in range(4)]
+        self.physical_idx = [4*index + i for i in range(4)]
+        self.module_current = 750 # mA
+        self.singles_rate = 1e5 # per module per second
+        self.period = 0x1000
+        self.counter_reset = [[time.monotonic()]*4 for _ in range(4)]
+        self.commands = 0
+        self.data_block = synthetic_data(1 << 20, seed = index)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *context):
+        self.stop()
+
+    @property
+    def power(self):
+        return (self.bank0 >> 4) & 0xF
+
+    def powered(self, m):
+        return bool(self.power & (1 << (m & 0x3)))
+
+    def start(self):
+        handlers = {'cmd': self.serve_cmd, 'info': self.serve_info,
+                    'data': self.serve_data, 'sys': self.serve_sys}
+
+        for name, port in self.ports.items():
+            srv = socket.create_server((self.ip, port))
+            self.servers.append(srv)
+            thr = threading.Thread(target = self.accept,
+                    args = [srv, handlers[name]], daemon = True)
+            thr.start()
+            self.threads.append(thr)
+
+        logging.info(f'Simulated {"sync" if self.is_sync else "backend"} at {self.ip}')
+
+    def stop(self):
+        self.stop_ev.set()
+        for srv in self.servers:
+            try:
+                srv.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            srv.close()
+        [thr.join() for thr in self.threads]
+
+    def accept(self, srv, handler):
+        while not self.stop_ev.is_set():
+            try:
+                c, addr = srv.accept()
+            except OSError: # socket was shutdown
+                return
+            threading.Thread(target = handler, args = [c], daemon = True).start()
+
+    def alarm(self, val):
+        """ report a word on the info port, e.g. over temperature """
+        for c in list(self.info_clients):
+            try:
+                c.sendall(val.to_bytes(4, 'big'))
+            except OSError:
+                self.info_clients.remove(c)
+
+    # Port handlers
+
+    def serve_cmd(self, c):
+        # reply to each word immediately, as the hardware does
+        c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with c:
+            while not self.stop_ev.is_set():
+                try:
+                    val = int.from_bytes(recv_exact(c, 4), 'big')
+                except OSError:
+                    return
+
+                if self.latency > 0:
+                    time.sleep(self.latency)
+
+                with self.lock:
+                    self.commands += 1
+                    resp = self.respond(val)
+
+                try:
+                    c.sendall(b''.join([r.to_bytes(4, 'big') for r in resp]))
+                except OSError:
+                    return
+
+    def serve_info(self, c):
+        self.info_clients.append(c)
+        self.stop_ev.wait()
+        c.close()
+
+    def serve_data(self, c):
+        chunk = 8192
+        offset = 0
+        t_next = time.monotonic()
+        with c:
+            while not self.stop_ev.is_set():
+                if offset + chunk > len(self.data_block):
+                    offset = 0
+
+                try:
+                    c.sendall(self.data_block[offset:offset+chunk])
+                except OSError:
+                    return
+                offset += chunk
+
+                if self.data_rate:
+                    t_next += chunk / self.data_rate
+                    delay = t_next - time.monotonic()
+                    if delay > 0: time.sleep(delay)
+
+    def serve_sys(self, c):
+        with c:
+            try:
+                req = c.recv(1024)
+            except OSError:
+                return
+
+            if req[0] == 0xF1:
+                # reboot
+                c.sendall(bytes([0xF1, 0x00, 0, 0]))
+            elif req[0] == 0xEE:
+                # spi, echo the data words back
+                c.sendall(bytes([0xEE, 0x00, 0, 0]) + req[12:])
+
+    # Command handling
+
+    def respond(self, val):
+        m, c, pld = cmd.module(val), cmd.command(val), cmd.payload(val)
+
+        if self.is_sync:
+            if val == cmd.CMD_EMPTY:
+                # time tag reset
+                return [val | 0x1]
+            if c == cmd.DAC_WRITE:
+                return [cmd.build(m, c, pld & 0xFFF)]
+            return [val]
+
+        if c == cmd.UPDATE_REG and (pld >> 16) != 0xF:
+            self.reg = pld & 0x3FFF
+            return [cmd.build(0, c, self.reg)]
+
+        if c in frontend_cmds or c == cmd.UPDATE_REG:
+            if not self.powered(m):
+                return [cmd.build(m, cmd.CMD_RESPONSE, 0)]
+            resp = self.respond_frontend(m, c, pld)
+            if self.relay_header:
+                return [cmd.build(m, cmd.CMD_RESPONSE, 1), resp]
+            return [resp]
+
+        if c == cmd.GPIO:
+            return [self.gpio(pld)]
+
+        if c == cmd.GET_CURRENT:
+            curr = self.module_current if self.powered(m) else 0
+            return [cmd.build(m, c, curr)]
+
+        if c == cmd.COUNTER_READ:
+            ch, div = pld & 0x3, (pld >> 2) & 0xF
+            now = time.monotonic()
+            elapsed = now - self.counter_reset[m & 0x3][ch]
+            self.counter_reset[m & 0x3][ch] = now
+            rate = self.singles_rate if self.powered(m) else 0
+            count = (int(rate * elapsed) >> div) & 0xFFFFF
+            return [cmd.build(m, c, count)]
+
+        # NOP and anything unknown is echoed
+        return [val]
+
+    def gpio(self, pld):
+        write  = (pld >> 18) & 0x3
+        bank   = (pld >> 16) & 0x3
+        offset = (pld >>  8) & 0xFF
+        mask   = (pld >>  4) & 0xF
+        value  = (pld >>  0) & 0xF
+
+        if write and bank == 0:
+            before = self.power
+            val = self.bank0
+            val &= ~(mask << offset)
+            val |= (mask & value) << offset
+            self.bank0 = val
+
+            if self.bank0 & (1 << 3):
+                # hard reset powers off the frontend
+                self.bank0 = 0
+
+            for i in range(4):
+                if (before & ~self.power) & (1 << i):
+                    # DAC values are lost when a module is powered off
+                    self.dac[i] = [0]*16
+
+        reg = self.bank0 if bank == 0 else 0
+        return cmd.build(0, cmd.GPIO, (reg >> offset) & mask)
+
+    def respond_frontend(self, m, c, pld):
+        if c == cmd.DAC_WRITE:
+            ch, val = (pld >> 12) & 0xF, pld & 0xFFF
+            self.dac[m & 0x3][ch] = val
+            return cmd.build(m, c, val)
+
+        if c == cmd.DAC_READ:
+            ch = (pld >> 12) & 0xF
+            return cmd.build(m, c, self.dac[m & 0x3][ch])
+
+        if c == cmd.ADC_READ:
+            ch = (pld >> 16) & 0x7
+            temp = self.temps[m & 0x3][ch] + random.uniform(-0.1, 0.1)
+            return cmd.build(m, c, temp_to_adc(temp))
+
+        if c == cmd.MODULE_ID:
+            return cmd.build(self.physical_idx[m & 0x3], c, 0)
+
+        if c == cmd.PERIOD_READ:
+            return cmd.build(m, c, (self.period >> (pld & 0xFF)) & 0xFFFFF)
+
+        if c == cmd.SGL_RATE_READ:
+            div = pld & 0xFF
+            return cmd.build(m, c, (int(self.singles_rate / 4) >> div) & 0xFFFFF)
+
+        return cmd.build(m, c, pld)
+
+class SimSystem():
+    """ A sync board and four backends on the default simulator addresses """
+
+    def __init__(self, sync_ip = sim_sync_ip, backend_ips = sim_backend_ips, **kwds):
+        self.sync = SimDevice(sync_ip, is_sync = True, **kwds)
+        self.backend = [SimDevice(ip, index = i, **kwds)
+                        for i, ip in enumerate(backend_ips)]
+
+    def __enter__(self):
+        [d.start() for d in [self.sync] + self.backend]
+        return self
+
+    def __exit__(self, *context):
+        [d.stop() for d in [self.sync] + self.backend]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Simulate the sync and backend boards')
+    parser.add_argument('--rate', type = float, default = 1e6,
+            help = 'data port byte rate per backend, 0 for unlimited')
+    parser.add_argument('--latency', type = float, default = 0.0,
+            help = 'delay in seconds before each command response')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    with SimSystem(data_rate = args.rate, latency = args.latency):
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt: pass
@@ -0,0 +1,643 @@
+import os, bisect, mmap, time, queue, socket, threading, logging, struct, zlib, collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# File-like sinks for backend.acquire. Anything with write() and close()
+# (and usable as a context manager) can be passed to acquire in place of
+# a filename, socket or queue.
+
+class FileWriter():
+    """ Double buffered file sink
+
+    The receive thread only copies each chunk into one of nbuffers
+    page-aligned buffers of buffer_size bytes. Full buffers are written
+    out by a dedicated thread, so socket reads and disk I/O overlap. If
+    every buffer is still waiting for the disk the receive thread blocks,
+    and the stall is counted and logged.
+
+    prealloc reserves that many bytes up front with fallocate (e.g. the
+    expected rate times the run length), the file is truncated to the
+    bytes actually written on close. fsync is one of 'never', 'close',
+    'buffer' (after every buffer) or a number of seconds between syncs.
+
+    A failed disk write (e.g. ENOSPC) is raised from the next write(),
+    or from close() if no write() came after it.
+    """
+
+    def __init__(self, path, buffer_size = 4 << 20, nbuffers = 2,
+                 prealloc = 0, fsync = 'close'):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.prealloc = prealloc
+        if prealloc > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, prealloc)
+            except OSError as e:
+                logging.warning(f'{path}: failed to preallocate {prealloc} bytes, {e}')
+
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        for _ in range(nbuffers):
+            self.free.put(mmap.mmap(-1, buffer_size))
+
+        self.buf = self.free.get()
+        self.fill = 0
+
+        self.offset = 0
+        self.written = 0
+        self.received = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.last_warning = 0.0
+        self.last_sync = time.monotonic()
+        self.error = None
+        self.raised = False
+
+        self.thr = threading.Thread(target = self.run)
+        self.thr.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'FileWriter({self.path})'
+
+    @property
+    def backlog(self):
+        """ number of full buffers waiting for the disk """
+        return self.full.qsize()
+
+    def check(self):
+        if self.error is not None and not self.raised:
+            self.raised = True
+            raise self.error
+
+    def write(self, data):
+        self.check()
+        data = memoryview(data).cast('B')
+        self.received += len(data)
+        while len(data) > 0:
+            n = min(len(data), self.buffer_size - self.fill)
+            self.buf[self.fill:self.fill+n] = data[:n]
+            self.fill += n
+            data = data[n:]
+
+            if self.fill == self.buffer_size:
+                self.swap()
+
+    def swap(self):
+        self.full.put((self.buf, self.fill))
+
+        try:
+            self.buf = self.free.get_nowait()
+        except queue.Empty:
+            # every buffer is queued for the disk, wait for one to free up
+            t = time.monotonic()
+            self.buf = self.free.get()
+            stall = time.monotonic() - t
+            self.stalls += 1
+            self.stall_time += stall
+
+            if t - self.last_warning > 10.0:
+                self.last_warning = t
+                logging.warning(f'{self.path}: disk is not keeping up, '
+                        f'receive stalled {self.stalls} times ({round(self.stall_time,3)} s)')
+
+        self.fill = 0
+
+    def run(self):
+        while True:
+            item = self.full.get()
+            if item is None: break
+
+            buf, n = item
+            try:
+                self.write_buffer(memoryview(buf)[:n])
+                self.written += n
+                self.sync_policy()
+            except OSError as e:
+                if self.error is None:
+                    self.error = e
+                logging.exception(f'{self.path}: write failed')
+
+            self.free.put(buf)
+
+    def write_buffer(self, view):
+        while len(view) > 0:
+            n = os.write(self.fd, view)
+            self.offset += n
+            view = view[n:]
+
+    def sync_policy(self):
+        if self.fsync == 'buffer':
+            os.fsync(self.fd)
+        elif isinstance(self.fsync, (int, float)):
+            now = time.monotonic()
+            if now - self.last_sync >= self.fsync:
+                os.fsync(self.fd)
+                self.last_sync = now
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        if self.fill > 0:
+            self.full.put((self.buf, self.fill))
+            self.fill = 0
+
+        self.full.put(None)
+        self.thr.join()
+
+        if self.prealloc > 0:
+            os.ftruncate(self.fd, self.offset)
+
+        if self.fsync != 'never':
+            os.fsync(self.fd)
+
+        os.close(self.fd)
+        self.fd = None
+        self.check()
+
+# Fan out to several sinks
+
+class SocketWriter():
+    """ sink adapter for a connected socket, e.g. the external sorter """
+
+    def __init__(self, s):
+        self.s = s
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'SocketWriter({self.s.getpeername()})'
+
+    def write(self, data):
+        self.s.sendall(data)
+
+    def close(self):
+        self.s.close()
+
+class QueueWriter():
+    """ sink adapter for a queue, write() raises queue.Full while it is
+    full so the caller counts the chunk as dropped
+    """
+
+    lossy = True
+
+    def __init__(self, q):
+        self.q = q
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        pass
+
+    def __repr__(self):
+        return 'QueueWriter()'
+
+    def write(self, data):
+        self.q.put_nowait(data)
+
+    def close(self):
+        pass
+
+class CallbackWriter():
+    """ sink adapter for a function called with every chunk """
+
+    def __init__(self, fun):
+        self.fun = fun
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        pass
+
+    def __repr__(self):
+        return f'CallbackWriter({self.fun})'
+
+    def write(self, data):
+        self.fun(data)
+
+    def close(self):
+        pass
+
+def as_writer(sink):
+    """ wrap any sink accepted by backend.acquire in a write()/close() object """
+    if isinstance(sink, str):
+        return FileWriter(sink)
+    if isinstance(sink, socket.socket):
+        return SocketWriter(sink)
+    if hasattr(sink, 'write'):
+        return sink
+    if hasattr(sink, 'put_nowait'):
+        return QueueWriter(sink)
+    if callable(sink):
+        return CallbackWriter(sink)
+    raise TypeError(f'Unsupported sink {sink!r}')
+
+class SinkStats():
+    """ bytes delivered to and dropped by one sink, and the seconds spent
+    waiting for it to accept data
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.delivered = 0
+        self.dropped = 0
+        self.blocked = 0.0
+
+    def __repr__(self):
+        return f'SinkStats({self.name})'
+
+    def as_dict(self):
+        return {'delivered': self.delivered,
+                'dropped': self.dropped,
+                'blocked': round(self.blocked, 3)}
+
+class Branch():
+    """ one output of a Tee, with its own bounded queue and thread
+
+    put() waits for room in the queue unless the sink is lossy (it has a
+    true lossy attribute, e.g. the UI preview). A lossy branch only
+    queues whole words, the bytes of a word split between chunks are
+    carried over to the next one, so dropping a chunk (here or in the
+    sink) keeps the stream the sink sees word aligned.
+    """
+
+    def __init__(self, sink, depth):
+        self.sink = as_writer(sink)
+        self.lossy = getattr(self.sink, 'lossy', False)
+        self.chunks = queue.Queue(maxsize = depth)
+        self.stats = SinkStats(repr(self.sink))
+        self.error = None
+        self.carry = b''
+        self.thr = threading.Thread(target = self.run)
+        self.thr.start()
+
+    def __repr__(self):
+        return f'Branch({self.sink})'
+
+    def put(self, data):
+        if not self.lossy:
+            t = time.perf_counter()
+            self.chunks.put(data)
+            self.stats.blocked += time.perf_counter() - t
+            return
+
+        if self.carry:
+            data = self.carry + data
+        n = len(data) - len(data) % 4
+        self.carry = bytes(data[n:])
+        if n == 0: return
+        if n < len(data): data = data[:n]
+
+        try:
+            self.chunks.put_nowait(data)
+        except queue.Full:
+            self.stats.dropped += n
+
+    def run(self):
+        with self.sink:
+            while True:
+                data = self.chunks.get()
+                if data is None: break
+                if self.error is not None:
+                    # keep draining so the producer never blocks
+                    self.stats.dropped += len(data)
+                    continue
+
+                t = time.perf_counter()
+                try:
+                    self.sink.write(data)
+                    self.stats.delivered += len(data)
+                except queue.Full:
+                    self.stats.dropped += len(data)
+                except Exception as e:
+                    self.error = e
+                    self.stats.dropped += len(data)
+                    logging.exception(f'{self.sink}: write failed, dropping further data')
+                self.stats.blocked += time.perf_counter() - t
+
+    def close(self):
+        if self.carry:
+            self.chunks.put(self.carry)
+        self.chunks.put(None)
+        self.thr.join()
+
+class Tee():
+    """ Sink that hands every chunk to several sinks
+
+    Each sink (a filename, socket, queue, callable or anything with
+    write()) gets a Branch with a queue of depth chunks, drained by its
+    own thread. The chunk itself is shared between the branches, not
+    copied per sink. Files, sockets and the sorter are lossless, a full
+    branch makes the receive loop wait for it. Lossy sinks (the preview,
+    queues) have whole words dropped and counted for that sink only, so
+    they never stall the receive loop or the other sinks.
+    """
+
+    def __init__(self, sinks, depth = 64):
+        self.branches = [Branch(s, depth) for s in sinks]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'Tee({self.branches})'
+
+    def write(self, data):
+        if len(data) == 0: return
+        if isinstance(data, memoryview):
+            # pooled receive buffers are reused, share one immutable copy
+            data = bytes(data)
+        for b in self.branches:
+            b.put(data)
+
+    def close(self):
+        [b.close() for b in self.branches]
+
+    @property
+    def stats(self):
+        """ SinkStats of every branch """
+        return [b.stats for b in self.branches]
+
+# Hot file rotation
+
+class RotatingWriter():
+    """ Sink that switches to a new output file while the receive loop
+    keeps running
+
+    rotate() requests a switch from any thread; it happens in the next
+    write(), at the first 4 byte word boundary of the stream, so no word
+    is split between files. A switch also happens automatically once the
+    current file holds max_bytes or is max_seconds old. Each file is
+    written by factory(path) (a FileWriter by default), the previous one
+    is closed on a background thread so the disk flush doesn't stall
+    the receive loop.
+
+    Without an explicit path the next file is named from path: with an
+    {index} field it is formatted with the file number, otherwise the
+    number is added before the extension (the first file is path itself).
+    """
+
+    def __init__(self, path, factory = FileWriter, max_bytes = None, max_seconds = None):
+        self.template = path
+        self.factory = factory
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+
+        self.index = 0
+        self.total = 0
+        self.lock = threading.Lock()
+        self.pending = collections.deque() # (path, Event) switch requests
+        self.closing = []
+        self.files = []
+        self.open(self.name(0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'RotatingWriter({self.template})'
+
+    def name(self, index):
+        if '{index' in self.template:
+            return self.template.format(index = index)
+        if index == 0:
+            return self.template
+        root, ext = os.path.splitext(self.template)
+        return f'{root}_{index:04d}{ext}'
+
+    def open(self, path):
+        self.path = path
+        self.out = self.factory(path)
+        self.opened = time.monotonic()
+        self.file_bytes = 0
+        self.files.append(path)
+
+    def rotate(self, path = None):
+        """ switch to path (or the next automatic name), returns an
+        Event that is set once the new file receives data
+        """
+        ev = threading.Event()
+        with self.lock:
+            self.pending.append((path, ev))
+        return ev
+
+    def limit_reached(self):
+        return ((self.max_bytes is not None and self.file_bytes >= self.max_bytes) or
+                (self.max_seconds is not None and
+                 time.monotonic() - self.opened >= self.max_seconds))
+
+    def write(self, data):
+        if len(self.pending) == 0 and self.limit_reached():
+            with self.lock:
+                self.pending.append((None, None))
+
+        if len(self.pending) > 0:
+            head = -self.total % 4
+            if head >= len(data):
+                self.put(data)
+                return
+
+            self.put(data[:head])
+            data = data[head:]
+            self.switch()
+
+        self.put(data)
+
+    def put(self, data):
+        if len(data) == 0: return
+        self.out.write(data)
+        self.total += len(data)
+        self.file_bytes += len(data)
+
+    def switch(self):
+        with self.lock:
+            path, ev = self.pending.popleft()
+        self.index += 1
+
+        old = self.out
+        thr = threading.Thread(target = old.close)
+        thr.start()
+        self.closing = [t for t in self.closing if t.is_alive()] + [thr]
+
+        self.open(path or self.name(self.index))
+        logging.debug(f'Rotated {old} to {self.path}')
+        if ev is not None: ev.set()
+
+    def close(self):
+        self.out.close()
+        [t.join() for t in self.closing]
+        with self.lock:
+            # nothing more is written, don't leave a rotate() waiting
+            for _, ev in self.pending:
+                if ev is not None: ev.set()
+            self.pending.clear()
+
+# Compressed frames and their index
+
+codecs = {}
+if zstandard is not None:
+    codecs['zstd'] = (lambda level: zstandard.ZstdCompressor(level = level).compress,
+                      lambda: zstandard.ZstdDecompressor().decompress)
+if lz4 is not None:
+    codecs['lz4'] = (lambda level: lambda d: lz4.frame.compress(d, compression_level = level),
+                     lambda: lz4.frame.decompress)
+codecs['zlib'] = (lambda level: lambda d: zlib.compress(d, level),
+                  lambda: zlib.decompress)
+
+index_magic = b'SGLIDX01'
+index_record = struct.Struct('>QQII')
+
+class CompressedWriter(FileWriter):
+    """ FileWriter that stores every buffer as an independently
+    decodable frame
+
+    The output goes to path + '.' + codec, next to an index file
+    (path + '.' + codec + '.idx') with one record per frame: raw offset,
+    file offset, raw length and compressed length. Compression runs on
+    the writer thread. codec defaults to the best one installed, zstd,
+    then lz4, then zlib from the standard library.
+    """
+
+    def __init__(self, path, codec = None, level = 3, **kwds):
+        if codec is None:
+            codec = next(c for c in ['zstd', 'lz4', 'zlib'] if c in codecs)
+
+        self.codec = codec
+        self.compress = codecs[codec][0](level)
+        path = f'{path}.{codec}'
+
+        self.index = open(path + '.idx', 'wb')
+        self.index.write(index_magic + codec.encode('ascii').ljust(8, b'\0'))
+        self.frames = 0
+
+        super().__init__(path, **kwds)
+
+    def __repr__(self):
+        return f'CompressedWriter({self.path})'
+
+    def write_buffer(self, view):
+        frame = self.compress(view)
+        self.index.write(index_record.pack(
+            self.written, self.offset, len(view), len(frame)))
+        self.frames += 1
+        super().write_buffer(memoryview(frame))
+
+    def sync_policy(self):
+        self.index.flush()
+        super().sync_policy()
+
+    def close(self):
+        super().close()
+        self.index.close()
+
+def read_frame_index(idx_path):
+    """ returns the codec name and a list of
+    (raw offset, file offset, raw length, compressed length)
+    """
+    with open(idx_path, 'rb') as f:
+        header = f.read(16)
+        if header[:8] != index_magic:
+            raise ValueError(f'{idx_path} is not a frame index')
+        codec = header[8:].rstrip(b'\0').decode('ascii')
+        records = list(index_record.iter_unpack(f.read()))
+    return codec, records
+
+def read_frame(path, codec, record):
+    """ decompress a single frame, independent of every other frame """
+    _, offset, _, length = record
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return codecs[codec][1]()(f.read(length))
+
+def compressed_path(path):
+    """ the CompressedWriter output written for path, or None """
+    for codec in ['zstd', 'lz4', 'zlib']:
+        if os.path.exists(f'{path}.{codec}.idx'):
+            return f'{path}.{codec}'
+    return None
+
+class FrameReader():
+    """ Read-only file object over the raw stream of a CompressedWriter
+    output, a read only decompresses the frames it covers
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.codec, self.frames = read_frame_index(path + '.idx')
+        if self.codec not in codecs:
+            raise ValueError(f'{path}: codec {self.codec} is not installed')
+        self.decompress = codecs[self.codec][1]()
+        self.starts = [r[0] for r in self.frames]
+        self.size = self.frames[-1][0] + self.frames[-1][2] if self.frames else 0
+
+        self.f = open(path, 'rb')
+        self.pos = 0
+        self.cached = None, b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def __repr__(self):
+        return f'FrameReader({self.path})'
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.size}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def frame(self, k):
+        if self.cached[0] != k:
+            _, offset, _, length = self.frames[k]
+            self.f.seek(offset)
+            self.cached = k, self.decompress(self.f.read(length))
+        return self.cached[1]
+
+    def read(self, n = -1):
+        end = self.size if n < 0 else min(self.size, self.pos + n)
+        out = bytearray()
+        while self.pos < end:
+            k = bisect.bisect_right(self.starts, self.pos) - 1
+            start = self.starts[k]
+            piece = self.frame(k)[self.pos - start:end - start]
+            if len(piece) == 0: break # truncated frame
+            out += piece
+            self.pos += len(piece)
+        return bytes(out)
+
+    def close(self):
+        self.f.close()
@@ -1,5 +1,5 @@
 import command, threading, queue, logging, socket
-from gigex import Gigex, ignore_network_errors, cmd_port
+from gigex import Gigex, ignore_network_errors, recv_exact, cmd_port
 import numpy as np
 from labjack import ljm
 from simple_pid import PID
@@ -19,12 +19,19 @@ def set_air_ljm(value):
     return results[0]
 
 class Sync():
-    def __init__(self, ip):
+    def __init__(self, ip, reactor = None, ports = None):
         self.ip = ip
-        self.gx = Gigex(self.ip)
+        self.gx = Gigex(self.ip, reactor, ports)
         self.temp_thread = None
         self.temp_queue = queue.Queue()
 
+        # devices reachable through the local command server, the owner
+        # appends the backend links (see System)
+        self.routes = [self.gx]
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.listener = None
+
     def __enter__(self):
         self.gx.start()
         self.set_network_led(clear = False)
@@ -33,11 +40,21 @@ class Sync():
         self.listener_thread.start()
 
     def __exit__(self, *context):
+        self.stop_server()
+        self.set_network_led(clear = True)
+        self.gx.stop()
+
+    def stop_server(self):
+        """ close the local command server and wait for its clients, it
+        has to go before any of the routed links stop
+        """
+        if self.listener is None:
+            return
+
         self.listener.shutdown(socket.SHUT_RDWR)
         self.listener.close()
         self.listener_thread.join()
-        self.set_network_led(clear = True)
-        self.gx.stop()
+        self.listener = None
 
     @ignore_network_errors(None)
     def set_network_led(self, clear = False):
@@ -108,14 +125,131 @@ class Sync():
         set_air_ljm(0.0)
 
     def remote_listener(self):
+        # every client gets its own thread and keeps its connection open
         while True:
             try:
                 c, addr = self.listener.accept()
             except OSError: # socket was shutdown
-                return
+                break
 
-            cmd = c.recv(1024)
-            cmd = int.from_bytes(cmd, 'big')
-            ret = self.gx.send(cmd)
-            c.sendall(ret.to_bytes(4, 'big'))
-            c.close()
+            thr = threading.Thread(target = self.remote_client, args = [c])
+            thr.start()
+            with self.clients_lock:
+                self.clients[c] = thr
+
+        with self.clients_lock:
+            clients = list(self.clients.items())
+        for c, thr in clients:
+            try:
+                c.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            thr.join()
+
+    def remote_client(self, c):
+        """ Serve one local client until it disconnects
+
+        The client writes 4 byte command words, any number at a time, and
+        reads back exactly one 4 byte word per word written, in order. A
+        command.route(n) word selects the device for the commands after it
+        (0, the default, is the sync board, 1 to 4 the backends) and is
+        echoed back, or answered with 0 and ignored if there is no such
+        device. A command that fails is also answered with 0. Consecutive
+        commands for the same device are sent to it as one pipelined batch.
+        """
+        device = 0
+        rx = b''
+        with c:
+            while True:
+                try:
+                    data = c.recv(4096)
+                except OSError:
+                    break
+                if len(data) == 0: break
+
+                rx += data
+                n = len(rx) // 4
+                words = [int.from_bytes(rx[i:i+4], 'big') for i in range(0, 4*n, 4)]
+                rx = rx[4*n:]
+
+                resp = []
+                batch = []
+                for w in words + [None]:
+                    if w is not None and not command.is_route(w):
+                        batch.append(w)
+                        continue
+
+                    resp += self.route_batch(device, batch)
+                    batch = []
+
+                    if w is not None:
+                        # an invalid route leaves the previous device selected
+                        n = w & 0xFFFFFFF
+                        if n < len(self.routes):
+                            device = n
+                        resp.append(w if n < len(self.routes) else 0)
+
+                try:
+                    c.sendall(b''.join([r.to_bytes(4, 'big') for r in resp]))
+                except OSError:
+                    break
+
+        with self.clients_lock:
+            self.clients.pop(c, None)
+
+    def route_batch(self, device, words):
+        if len(words) == 0:
+            return []
+        if device >= len(self.routes):
+            return [0] * len(words)
+
+        try:
+            resp = self.routes[device].send_many(words, return_exceptions = True)
+        except Exception as e:
+            logging.debug(f'Local command batch to device {device} failed, {e}')
+            return [0] * len(words)
+
+        return [0 if isinstance(r, Exception) else r for r in resp]
+
+class CommandClient():
+    """ Persistent connection to the local command server of a running
+    Sync, e.g. from automation scripts while the UI owns the hardware
+    """
+
+    def __init__(self, host = '127.0.0.1', port = cmd_port, timeout = 5.0):
+        self.s = socket.create_connection((host, port), timeout = timeout)
+        self.device = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *context):
+        self.close()
+
+    def close(self):
+        self.s.close()
+
+    def send_many(self, words, device = 0):
+        """ responses to words sent to device (0 is the sync board, 1 to 4
+        the backends) in one round trip, 0 for a command that failed
+        """
+        words = list(words)
+        route = []
+        if device != self.device:
+            route = [command.route(device)]
+
+        out = route + words
+        self.s.sendall(b''.join([w.to_bytes(4, 'big') for w in out]))
+        resp = recv_exact(self.s, 4 * len(out))
+        resp = [int.from_bytes(resp[i:i+4], 'big') for i in range(0, len(resp), 4)]
+
+        if len(route) > 0:
+            if resp[0] != route[0]:
+                # the server's device is unknown now, route the next request
+                self.device = None
+                raise ValueError(f'No device {device} on the command server')
+            self.device = device
+            resp = resp[1:]
+        return resp
+
+    def send(self, word, device = 0):
+        return self.send_many([word], device)[0]
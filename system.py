@@ -1,60 +1,273 @@
-import os, shutil, logging, time, threading, glob, socket, subprocess, sys
+import os, logging, time, threading, glob, socket, subprocess, sys
 from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, wait
 from sync import Sync
 from backend import Backend
+from reactor import Reactor
+from sinks import FileWriter, RotatingWriter
+from sgl import ContainerWriter
+from coincidence import CoincidenceSorter
+from metrics import Exporter
+from telemetry import Telemetry
+from timeseries import TimeSeriesStore
+from relocate import Relocator
 
 sorter_bin = '/usr/local/bin/sorter'
 online_coincidence_file = '/mnt/acq/online.COIN'
+# coincidence.coin_dtype records, not the sorter binary's online.COIN format
+builtin_coincidence_file = '/mnt/acq/builtin.COIN'
 sorter_base_port = 10000
 
+sync_ip = '192.168.1.100'
+backend_ips = ['192.168.1.101', '192.168.1.102', '192.168.1.103', '192.168.1.104']
+
 class System():
-    def __init__(self):
-        self.sync = Sync('192.168.1.100')
-        backend_ips = ['192.168.1.101', '192.168.1.102', '192.168.1.103', '192.168.1.104']
-        self.data_dir = '/mnt/acq'
-        self.backend = [Backend(a) for a in backend_ips]
+    def __init__(self, reactor = False, acq_opts = None, sync_ip = sync_ip,
+                 backend_ips = backend_ips, ports = None, data_dir = '/mnt/acq',
+                 file_sink = None, container = False, builtin_sorter = False,
+                 metrics_port = None, metrics_file = None, telemetry_dir = None,
+                 rotate_limits = None):
+        """ ports optionally overrides cmd_port, info_port, sys_port and
+        data_port for every device, e.g. to point at the simulator.
+        file_sink is an optional callable that takes the singles file path
+        and returns the sink to write it with, e.g.
+        functools.partial(sinks.CompressedWriter, codec = 'zstd').
+        With container set, each file gets an sgl.ContainerWriter header
+        and time index. builtin_sorter selects the in-process coincidence
+        sorter (coincidence.CoincidenceSorter) instead of sorter_bin, its
+        records are written to builtin_coincidence_file.
+        metrics_port serves Prometheus metrics on that loopback port and
+        metrics_file rewrites them to a file every 10 s. Monitor
+        readings are stored in telemetry_dir (default data_dir/telemetry)
+        as a timeseries.TimeSeriesStore. rotate_limits writes each
+        singles file as a sinks.RotatingWriter that starts a new file at
+        those limits (e.g. {'max_seconds': 600}, or {} for none), and
+        rotate() switches every file on request. Files of a stopped
+        acquisition are moved to their data directory in the background
+        by a relocate.Relocator.
+        """
+        # in reactor mode a single event loop owns every device socket
+        self.reactor = Reactor() if reactor else None
+        self.sync = Sync(sync_ip, self.reactor, ports)
+        self.data_dir = data_dir
+        self.file_sink = file_sink
+        self.container = container
+        self.builtin_sorter = builtin_sorter
+        self.sorter = None
+        self.coincidence_file = None
+        self.rotate_limits = rotate_limits
+        self.rotating = []
+        self.relocator = Relocator()
+        self.metrics = None
+        if metrics_port is not None or metrics_file is not None:
+            self.metrics = Exporter(metrics_port, metrics_file)
+        self.backend = [Backend(a, self.reactor, acq_opts, ports, monitor = False)
+                        for a in backend_ips]
+        self.sync.routes += [b.gx for b in self.backend]
+
+        # one worker per gigex link, so every backend can be queried at once
+        self.executor = ThreadPoolExecutor(max_workers = len(self.backend) + 1)
+
+        # a single monitor poll feeds the UI, the monitor log and the PID
+        self.telemetry = Telemetry(self.backend, executor = self.executor)
+        self.telemetry.subscribe(self.publish_telemetry)
+        self.store = TimeSeriesStore(telemetry_dir or os.path.join(data_dir, 'telemetry'))
+        self.telemetry.subscribe(self.store.put_many)
 
     def __getattr__(self, attr):
-        return lambda *args, **kwds: [getattr(b, attr)(*args, **kwds) for b in self.backend]
+        def fan_out(*args, deadline = None, **kwds):
+            fun = lambda b: getattr(b, attr)(*args, **kwds)
+            return self.map_backends(fun, deadline = deadline)
+        return fan_out
+
+    def map_backends(self, fun, *iterables, deadline = None):
+        """ call fun(backend, *args) for every backend concurrently
+
+        Results are returned in backend order. Backends that have not
+        answered within deadline seconds report None.
+        """
+        futures = [self.executor.submit(fun, *a) for a in zip(self.backend, *iterables)]
+        wait(futures, timeout = deadline)
+        return [f.result() if f.done() else None for f in futures]
 
     def __enter__(self):
         with ExitStack() as stack:
+            # shut down last, telemetry and the backends use the workers
+            stack.callback(self.executor.shutdown, wait = True, cancel_futures = True)
+            if self.reactor is not None:
+                stack.enter_context(self.reactor)
+            if self.metrics is not None:
+                stack.enter_context(self.metrics)
             [stack.enter_context(b) for b in ([self.sync] + self.backend)]
+            # local clients are routed to the backend links, stop them first
+            stack.callback(self.sync.stop_server)
+            stack.enter_context(self.relocator)
+            stack.enter_context(self.store)
+            stack.enter_context(self.telemetry)
             self._stack = stack.pop_all()
         return self
     
     def __exit__(self, *context):
-        self._stack.__exit__(self, *context)
+        self._stack.__exit__(*context)
+
+    def publish_telemetry(self, snaps):
+        [b.publish(s) for b, s in zip(self.backend, snaps)]
+        self.sync.temp_queue.put([s.temps for s in snaps])
+
+    def set_power(self, states = [[False]*4]*4, deadline = None):
+        return self.map_backends(lambda b,s: b.set_power(s), states,
+                                 deadline = deadline)
+
+    def power_sequence(self, turn_on = True, budget = 4, settle = 1.0, poll = 0.05,
+                       on_current = 100, off_current = 50, progress = None):
+        """ switch every module on (or off) within an inrush budget
+
+        At most budget modules switch at once. The next group starts as
+        soon as the currents (mA) of the last one have settled: above
+        on_current and within 5% of the previous reading when turning on,
+        below off_current when turning off. A group that has not settled
+        after settle seconds is logged and the sequence moves on.
+        progress(done, total) is called after every group. Returns the
+        final power states.
+        """
+        states = [list(p) for p in self.get_power(verify = True)]
+        pending = [(b, m) for m in range(4) for b in range(len(self.backend))
+                   if states[b][m] != turn_on]
+        total, done = len(pending), 0
+
+        while len(pending) > 0:
+            group, pending = pending[:budget], pending[budget:]
+            for b, m in group: states[b][m] = turn_on
+
+            touched = sorted({b for b, _ in group})
+            wait([self.executor.submit(self.backend[b].set_power, states[b])
+                  for b in touched])
+
+            if not self.wait_settled(group, turn_on, settle, poll, on_current, off_current):
+                logging.warning(f'Power {"on" if turn_on else "off"} of {group} '
+                                f'did not settle within {settle} s')
+
+            done += len(group)
+            if progress is not None: progress(done, total)
+
+        return self.get_power()
+
+    def wait_settled(self, group, turn_on, settle, poll, on_current, off_current):
+        touched = sorted({b for b, _ in group})
+        deadline = time.monotonic() + settle
+        last = {}
+
+        while True:
+            futures = [self.executor.submit(self.backend[b].get_current) for b in touched]
+            currs = dict(zip(touched, [f.result() for f in futures]))
+
+            def settled(b, m):
+                c, prev = currs[b][m], last.get(b, [None]*4)[m]
+                if c < 0: return False
+                if not turn_on: return c <= off_current
+                return c >= on_current and prev is not None and abs(c - prev) <= 0.05 * c
 
-    def set_power(self, states = [[False]*4]*4):
-        return [b.set_power(s) for b,s in zip(self.backend, states)]
+            if all(settled(b, m) for b, m in group):
+                return True
 
-    def sys_status(self, data_queue):
-        sync     = self.sync.get_status()
-        backend  = self.get_status()
-        power    = self.get_power()
-        enum     = self.get_physical_idx()
+            if time.monotonic() >= deadline:
+                return False
+
+            last = currs
+            time.sleep(poll)
+
+    def sys_status(self, data_queue, deadline = None):
+        def status(b):
+            return b.get_status(), b.get_power(), b.get_physical_idx()
+
+        sync = self.executor.submit(self.sync.get_status)
+        stat = self.map_backends(status, deadline = deadline)
+        stat = [s or (False, [False]*4, [-1]*4) for s in stat]
+        backend, power, enum = [list(s) for s in zip(*stat)]
+
+        wait([sync], timeout = None if deadline is None else 0)
+        sync = sync.result() if sync.done() else False
         data_queue.put((sync, backend, power, enum))
 
-    def acq_start(self, finished, coincidences = False):
+    def snapshot(self, be):
+        """ configuration recorded in the container header """
+        return {'ip': be.ip,
+                'sync_ip': self.sync.ip,
+                'power': be.get_power(),
+                'physical_idx': be.get_physical_idx(),
+                'bias': be.get_bias(),
+                'thresh': be.get_thresh(),
+                'acq_opts': be.acq_opts}
+
+    def file_sink_for(self, be):
+        sink = os.path.join(self.data_dir, be.ip + '.SGL')
+        if self.container:
+            meta = self.snapshot(be)
+            factory = lambda p: ContainerWriter(p, meta, writer = self.file_sink or FileWriter)
+        elif self.file_sink is not None:
+            factory = self.file_sink
+        elif self.rotate_limits is not None:
+            factory = FileWriter
+        else:
+            return sink
+
+        if self.rotate_limits is None:
+            return factory(sink)
+
+        sink = RotatingWriter(sink, factory, **self.rotate_limits)
+        self.rotating.append(sink)
+        return sink
+
+    def rotate(self, timeout = None):
+        """ start a new file for every backend without stopping the
+        acquisition, returns True once every backend has switched
+        """
+        events = [s.rotate() for s in self.rotating]
+        return all([ev.wait(timeout) for ev in events])
+
+    def acq_start(self, finished, coincidences = False, record = False, preview = False):
+        """ with coincidences the backend streams go to the online sorter,
+        record additionally writes the raw singles files and preview
+        also feeds each backend's UI preview
+        """
         self.sorter = None
-        if coincidences:
+        self.coincidence_file = None
+        self.rotating = []
+        builtin = self.builtin_sorter
+
+        if coincidences and builtin:
+            logging.warning('Using the in-process coincidence sorter, its output '
+                            f'{builtin_coincidence_file} is not in the online.COIN format')
+            self.coincidence_file = builtin_coincidence_file
+            self.sorter = CoincidenceSorter(self.coincidence_file, len(self.backend))
+        elif coincidences:
             logging.debug('Start online coincidence processor')
-            self.sorter = subprocess.Popen([sorter_bin, online_coincidence_file],
+            self.coincidence_file = online_coincidence_file
+            self.sorter = subprocess.Popen([sorter_bin, self.coincidence_file],
                                            stdout = sys.stdout, stderr = sys.stderr)
 
         self.detector_disable(True)
         time.sleep(1)
         running = []
         for idx, be in enumerate(self.backend):
-            if coincidences:
+            sinks = []
+            be_preview = preview
+            if coincidences and builtin:
+                sinks.append(self.sorter.input(idx))
+            elif coincidences:
                 try:
-                    sink = socket.create_connection(('127.0.0.1', sorter_base_port + idx))
+                    sinks.append(socket.create_connection(('127.0.0.1', sorter_base_port + idx)))
                 except:
-                    sink = be.ui_data_queue
+                    be_preview = True
                     logging.exception('Failed to connect to online coincidence processor')
-            else:
-                sink = os.path.join(self.data_dir, be.ip + '.SGL')
+
+            if record or not coincidences:
+                sinks.append(self.file_sink_for(be))
+
+            if be_preview:
+                sinks.append(be.ui_preview)
+
+            sink = sinks[0] if len(sinks) == 1 else sinks
 
             r = threading.Event()
             be.dest.put((sink, r))
@@ -66,28 +279,39 @@ class System():
         self.detector_disable(False)
         finished.set()
 
-    def acq_stop(self, finished, data_dir):
+    def acq_stop(self, finished, data_dir, timeout = 30.0):
+        """ returns as soon as every file is closed, the files are then
+        moved to data_dir in the background. Returns the
+        relocate.Relocation (None without data_dir).
+        """
         self.detector_disable(True)
 
         for be in self.backend:
-            be.dest.put((be.ui_data_queue,))
+            be.acq_closed.clear()
+            be.dest.put((be.ui_preview,))
+
+        for be in self.backend:
+            if not be.acq_closed.wait(timeout):
+                logging.error(f'{be.ip}: acquisition did not stop within {timeout} s')
+
+        files = glob.glob('*.SGL*', root_dir = self.data_dir)
+        files = [os.path.join(self.data_dir, f) for f in files]
 
         if self.sorter is not None:
-            files = [online_coincidence_file]
+            files.append(self.coincidence_file)
             try:
                 self.sorter.wait(10.0)
             except subprocess.TimeoutExpired:
                 logging.exception('Online coincidence sorter did not stop cleanly, killing')
                 self.sorter.kill()
-        else:
-            files = glob.glob('*.SGL', root_dir = self.data_dir)
-            files = [os.path.join(self.data_dir, f) for f in files]
 
+        job = None
         if data_dir:
             try:
-                for f in files: shutil.move(f, data_dir)
+                job = self.relocator.relocate(files, data_dir)
             except:
                 logging.exception('Failed to move acquition files')
 
         self.sorter = None
         finished.set()
+        return job
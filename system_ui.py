@@ -19,8 +19,8 @@ class PowerPopup(tk.Toplevel):
         self.popup_status = tk.Label(self, text = 'Module: 0')
         self.popup_status.pack(pady = 20, padx = 40)
 
-    def set(self, i):
-        self.popup_status.config(text = f'Module: {i}')
+    def set(self, done, total):
+        self.popup_status.config(text = f'Modules: {done}/{total}')
 
 class WarningPopup(tk.Toplevel):
     def __init__(self, root, message):
@@ -51,6 +51,10 @@ class SystemUI(tk.Tk):
     def statusbar_acq_handler(self, running):
         self.statusbar_acq_label.config(text = 'Acq: {}'.format('RUN' if running else 'STOP'))
 
+    def statusbar_move_handler(self, done, total):
+        text = f'Moving files: {100 * done // total}%' if total > 0 else ''
+        self.statusbar_move_label.config(text = text)
+
     def cmd_output_print(self, value):
         self.cmd_output.delete(1.0, 'end')
         self.cmd_output.insert('end', str(value) + "\n")
@@ -103,7 +107,7 @@ class SystemUI(tk.Tk):
 
     def get_power(self):
         # TODO move to background thread
-        states_in = self.sys.get_power()
+        states_in = self.sys.get_power(verify = True)
         self.set_pwr_vars(states_in)
         states_out = self.get_pwr_vars()
         if states_out != states_in:
@@ -122,25 +126,32 @@ class SystemUI(tk.Tk):
         self.statusbar_bias_handler(turn_on)
 
     def toggle_power(self, turn_on = False):
-        nmodules = 4
         popup = PowerPopup(self, turn_on)
         self.pwr_tog.config(state = tk.DISABLED)
-        starting_pwr = self.sys.get_power()
-
-        def set_next_pwr(pwr, i):
-            if i < nmodules:
-                for p in pwr: p[i] = turn_on
-                new_pwr = self.sys.set_power(pwr)
-                self.set_pwr_vars(new_pwr)
-                popup.set(i)
-                popup.after(1000, set_next_pwr, pwr, i + 1)
-            else:
-                popup.destroy()
-                self.pwr_tog.config(state = tk.NORMAL)
-                self.statusbar_power_handler(turn_on)
-                self.get_status()
+        progress = [0, 0]
+        result = queue.Queue()
+
+        def set_progress(done, total):
+            progress[:] = [done, total]
 
-        set_next_pwr(starting_pwr, 0)
+        def check_pwr():
+            try:
+                new_pwr = result.get_nowait()
+            except queue.Empty:
+                popup.set(*progress)
+                self.after(100, check_pwr)
+                return
+
+            self.set_pwr_vars(new_pwr)
+            popup.destroy()
+            self.pwr_tog.config(state = tk.NORMAL)
+            self.statusbar_power_handler(turn_on)
+            self.get_status()
+
+        # sequencing runs in the background, paced by the module currents
+        threading.Thread(target = lambda: result.put(self.sys.power_sequence(
+            turn_on, progress = set_progress))).start()
+        check_pwr()
 
     def start_acq(self):
         self.acq_start_button.config(state = tk.DISABLED)
@@ -188,11 +199,20 @@ class SystemUI(tk.Tk):
                 title = "Directory to store data",
                 initialdir = "/")
 
+        def move_check_fun():
+            # files are moved in the background, a new acquisition can
+            # already be started
+            done, total = self.sys.relocator.backlog()
+            self.statusbar_move_handler(done, total)
+            if total > 0:
+                self.after(500, move_check_fun)
+
         def acq_check_fun():
             if finished.is_set():
                 self.acq_start_button.config(state = tk.NORMAL)
                 self.statusbar_acq_handler(False)
                 monitor_log.info(f'end acq at {datetime.now()}')
+                move_check_fun()
             else:
                 self.after(100, acq_check_fun)
 
@@ -212,16 +232,11 @@ class SystemUI(tk.Tk):
         self.acq_start_button.config(state = newstate)
 
         for be in self.sys.backend:
-            target = be.ui_data_queue if enable else None
+            target = be.ui_preview if enable else None
             be.dest.put((target,))
 
     # polled functions
 
-    def temp_monitor(self):
-        self.after(10000, self.temp_monitor)
-        vals = [b.temps for b in self.backend]
-        self.sync.sync.temp_queue.put(vals)
-
     def info(self):
         for be in self.sys.backend:
             try:
@@ -273,12 +288,14 @@ class SystemUI(tk.Tk):
         self.statusbar_power_label = tk.Label(self.statusbar_frame)
         self.statusbar_bias_label = tk.Label(self.statusbar_frame)
         self.statusbar_acq_label = tk.Label(self.statusbar_frame)
+        self.statusbar_move_label = tk.Label(self.statusbar_frame)
 
         self.statusbar_label.pack(side = tk.LEFT, padx = 5)
         self.statusbar_enum.pack(side = tk.LEFT, padx = 5)
         self.statusbar_power_label.pack(side = tk.LEFT, padx = 5)
         self.statusbar_bias_label.pack(side = tk.LEFT, padx = 5)
         self.statusbar_acq_label.pack(side = tk.LEFT, padx = 5)
+        self.statusbar_move_label.pack(side = tk.LEFT, padx = 5)
 
         self.statusbar_status_handler(False)
         self.statusbar_enum_handler(False)
@@ -405,5 +422,4 @@ class SystemUI(tk.Tk):
         self.cmd_output.pack(**button_pack_args)
 
         self.info()
-        self.temp_monitor()
         self.get_status()
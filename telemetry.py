@@ -0,0 +1,60 @@
+import threading, logging
+from concurrent.futures import ThreadPoolExecutor
+
+# A single monitor loop for the whole system. Each poll reads every
+# backend concurrently, one pipelined request per backend (see
+# Backend.snapshot), and the same list of snapshots is handed to every
+# subscriber, so the UI, the monitor log and the temperature PID all see
+# one consistent reading instead of polling on their own.
+
+class Telemetry():
+    def __init__(self, backends, interval = 10.0, executor = None):
+        self.backends = backends
+        self.interval = interval
+        self.executor = executor or ThreadPoolExecutor(max_workers = len(backends))
+        self.subscribers = []
+        self.latest = None
+        self.exit = threading.Event()
+        self.thr = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *context):
+        self.stop()
+
+    def subscribe(self, fun):
+        """ fun is called with the list of Snapshots (in backend order)
+        after every poll, on the telemetry thread
+        """
+        self.subscribers.append(fun)
+
+    def start(self):
+        self.exit.clear()
+        self.thr = threading.Thread(target = self.run)
+        self.thr.start()
+
+    def stop(self):
+        self.exit.set()
+        if self.thr is not None:
+            self.thr.join()
+        self.thr = None
+
+    def run(self):
+        while True:
+            self.poll()
+            if self.exit.wait(self.interval):
+                return
+
+    def poll(self):
+        snaps = list(self.executor.map(lambda b: b.snapshot(), self.backends))
+        self.latest = snaps
+
+        for fun in self.subscribers:
+            try:
+                fun(snaps)
+            except Exception:
+                logging.exception(f'Telemetry subscriber {fun} failed')
+
+        return snaps
@@ -0,0 +1,171 @@
+import os, queue, threading, logging, time
+import numpy as np
+
+# Append-only columnar store for monitor telemetry
+#
+# <root>/<ip>/<YYYYMMDD>/<column>   one directory per backend and UTC day
+#
+# Every column is a flat file of fixed size little-endian rows, appended
+# in batches by a writer thread, so a column of a day is one memmap and a
+# time range is found with a binary search on the time column. Missing
+# readings (the -1 the monitor reports) are stored as they are.
+
+columns = {'time':     ('<f8', ()),     # wall clock, seconds since the epoch
+           'temps':    ('<f4', (4, 8)),
+           'currents': ('<i4', (4,)),
+           'singles':  ('<i8', (4,))}
+
+def row_bytes(name):
+    dtype, shape = columns[name]
+    return np.dtype(dtype).itemsize * int(np.prod(shape))
+
+def day(t):
+    return time.strftime('%Y%m%d', time.gmtime(t))
+
+class TimeSeriesStore():
+    """ Writes backend Snapshots from a queue and reads them back
+
+    put() never blocks, snapshots are dropped (and counted) if the queue
+    is full. Rows are appended every flush_interval seconds or once
+    batch_rows are waiting.
+    """
+
+    def __init__(self, root, depth = 1024, batch_rows = 256, flush_interval = 5.0):
+        self.root = root
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.rows = queue.Queue(maxsize = depth)
+        self.dropped = 0
+        self.thr = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *context):
+        self.stop()
+
+    def start(self):
+        self.thr = threading.Thread(target = self.run)
+        self.thr.start()
+
+    def stop(self):
+        self.rows.put(None)
+        self.thr.join()
+
+    def put(self, snap):
+        if not snap.status: return
+        try:
+            self.rows.put_nowait(snap)
+        except queue.Full:
+            self.dropped += 1
+
+    def put_many(self, snaps):
+        [self.put(s) for s in snaps]
+
+    def run(self):
+        pending = []
+        last = time.monotonic()
+        done = False
+        while not done:
+            try:
+                snap = self.rows.get(timeout = self.flush_interval)
+                if snap is None:
+                    done = True
+                else:
+                    pending.append(snap)
+            except queue.Empty: pass
+
+            now = time.monotonic()
+            if len(pending) >= self.batch_rows or now - last >= self.flush_interval or done:
+                try:
+                    self.append(pending)
+                except OSError:
+                    logging.exception(f'Failed to write telemetry to {self.root}')
+                pending = []
+                last = now
+
+    def append(self, snaps):
+        groups = {}
+        for s in snaps:
+            t = s.timestamp.timestamp()
+            groups.setdefault((s.ip, day(t)), []).append((t, s))
+
+        for (ip, d), rows in groups.items():
+            path = os.path.join(self.root, ip, d)
+            os.makedirs(path, exist_ok = True)
+            values = {'time':     [t for t, _ in rows],
+                      'temps':    [s.temps for _, s in rows],
+                      'currents': [s.currents for _, s in rows],
+                      'singles':  [s.singles for _, s in rows]}
+
+            for name, (dtype, _) in columns.items():
+                with open(os.path.join(path, name), 'ab') as f:
+                    np.asarray(values[name], dtype = dtype).tofile(f)
+
+    # Queries
+
+    def days(self, ip, t_start, t_stop):
+        base = os.path.join(self.root, ip)
+        if not os.path.isdir(base):
+            return []
+        first, last = day(t_start), day(t_stop)
+        return [os.path.join(base, d) for d in sorted(os.listdir(base))
+                if first <= d <= last]
+
+    def read_column(self, path, name, nrows):
+        dtype, shape = columns[name]
+        fname = os.path.join(path, name)
+        if nrows == 0:
+            return np.zeros((0,) + shape, dtype = dtype)
+        return np.memmap(fname, dtype = dtype, mode = 'r', shape = (nrows,) + shape)
+
+    def read(self, ip, column, t_start, t_stop):
+        """ (times, values) of one column in [t_start, t_stop), times
+        are seconds since the epoch
+        """
+        times, values = [], []
+        for path in self.days(ip, t_start, t_stop):
+            # rows still being appended to other columns are ignored
+            nrows = min(os.path.getsize(os.path.join(path, name)) // row_bytes(name)
+                        if os.path.exists(os.path.join(path, name)) else 0
+                        for name in columns)
+
+            t = self.read_column(path, 'time', nrows)
+            lo, hi = np.searchsorted(t, [t_start, t_stop])
+            times.append(np.array(t[lo:hi]))
+            values.append(np.array(self.read_column(path, column, nrows)[lo:hi]))
+
+        if len(times) == 0:
+            dtype, shape = columns[column]
+            return np.zeros(0), np.zeros((0,) + shape, dtype = dtype)
+        return np.concatenate(times), np.concatenate(values)
+
+    def query(self, ip, column, t_start, t_stop, step = None):
+        """ time range read downsampled into step second bins
+
+        Returns a dict with the bin start times and the min, max and mean
+        of every bin. Negative (missing) readings are left out of the
+        statistics, a bin with none left is NaN. Without step the raw
+        rows are returned as min = max = mean.
+        """
+        t, v = self.read(ip, column, t_start, t_stop)
+        v = v.astype(np.float64)
+        v[v < 0] = np.nan
+
+        if step is None or len(t) == 0:
+            return {'time': t, 'min': v, 'max': v, 'mean': v}
+
+        bins = np.floor((t - t_start) / step).astype(np.int64)
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+
+        valid = ~np.isnan(v)
+        total = np.add.reduceat(np.where(valid, v, 0.0), starts)
+        count = np.add.reduceat(valid.astype(np.int64), starts)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean = total / count
+
+        return {'time': t_start + bins[starts] * step,
+                'min':  np.fmin.reduceat(v, starts),
+                'max':  np.fmax.reduceat(v, starts),
+                'mean': mean}